@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+"""
+hmp_cached_md5.py
+~~~~~~~~~~~~~~~~~
+
+A drop-in replacement for md5sum that caches each file's checksum in a
+user.md5sum extended attribute (tagged with the file size and modification
+time) so that unchanged files are not re-hashed when a workflow is re-run.
+
+Output and check-mode input follow the md5sum format.
+
+Copyright (c) 2017 Harvard School of Public Health
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in
+    all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+    THE SOFTWARE.
+"""
+
+import argparse
+import sys
+
+from hmp2_workflows.tasks.common import cached_md5
+
+
+def parse_cli_arguments():
+    """Parses any command-line arguments passed into this script.
+
+    Args:
+        None
+
+    Requires:
+        None
+
+    Returns:
+        argparse.ArgumentParser: argparse object containing the arguments
+            passed in by the user.
+    """
+    parser = argparse.ArgumentParser('Computes (or checks) md5 checksums '
+                                     're-using checksums cached in file '
+                                     'extended attributes.')
+    parser.add_argument('files', nargs='+',
+                        help='Files to checksum or, with --check, files '
+                        'containing md5sum formatted checksums ("-" for '
+                        'stdin).')
+    parser.add_argument('-c', '--check', action='store_true', default=False,
+                        help='Read checksums from the provided files and '
+                        'check them.')
+
+    return parser.parse_args()
+
+
+def check_checksums(checksums_fh):
+    """Verifies all checksums found in the provided md5sum formatted file
+    handle.
+
+    Args:
+        checksums_fh (file): File handle containing md5sum formatted lines.
+
+    Requires:
+        None
+
+    Returns:
+        int: The number of files that failed verification.
+    """
+    failures = 0
+
+    for line in checksums_fh:
+        line = line.rstrip('\n')
+        if not line:
+            continue
+
+        (expected_md5, file_path) = line.split(None, 1)
+        file_path = file_path.lstrip('*')
+
+        if cached_md5(file_path) == expected_md5.lower():
+            print("%s: OK" % file_path)
+        else:
+            print("%s: FAILED" % file_path)
+            failures += 1
+
+    return failures
+
+
+def main(args):
+    if args.check:
+        failures = 0
+        for checksums_file in args.files:
+            if checksums_file == '-':
+                failures += check_checksums(sys.stdin)
+            else:
+                with open(checksums_file) as checksums_fh:
+                    failures += check_checksums(checksums_fh)
+
+        if failures:
+            sys.stderr.write("WARNING: %s computed checksum(s) did NOT match\n"
+                             % failures)
+            sys.exit(1)
+    else:
+        for file_path in args.files:
+            print("%s  %s" % (cached_md5(file_path), file_path))
+
+
+if __name__ == "__main__":
+    main(parse_cli_arguments())
@@ -29,9 +29,14 @@ furnished to do so, subject to the following conditions:
 
 
 import argparse
+import errno
+import logging
 import os
-import sys
+import queue
 import tempfile
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
 
 from time import sleep
 
@@ -42,6 +47,9 @@ from paramiko import SSHClient, AutoAddPolicy
 from scp import SCPClient
 
 
+logger = logging.getLogger(__name__)
+
+
 def parse_cli_arguments():
     """
     Parses any command-line arguments passed into this script.
@@ -57,10 +65,17 @@ def parse_cli_arguments():
     """
     parser = argparse.ArgumentParser('Sets up and fans out HMP2 metagenomic '
                                      'assemblies on AWS.')
-    parser.add_argument('-f', '--forward-read', required=True,
+    parser.add_argument('-f', '--forward-read',
                         help='Forward metagenomic sequence read.')
-    parser.add_argument('-r', '--reverse-read', required=True,
+    parser.add_argument('-r', '--reverse-read',
                         help='Reverse metagenomic sequence read.')
+    parser.add_argument('-s', '--samples-tsv',
+                        help='Tab-delimited file containing one forward and '
+                        'reverse sequence read pair per line. Takes the place '
+                        'of --forward-read and --reverse-read.')
+    parser.add_argument('-n', '--n-workers', type=int, default=1,
+                        help='OPTIONAL. Number of EC2 instances to fan '
+                        'assemblies out across. [DEFAULT: 1]')
     parser.add_argument('-o', '--output-dir', required=True,
                         help='Output directory to download assembled '
                         'metagenome too.')
@@ -73,8 +88,66 @@ def parse_cli_arguments():
     parser.add_argument('-ami', '--ami-id', default='ami-14bed66e',
                         help='OPTIONAL. AMI ID for AWS image containing '
                         'IGS assembly pipeline.')
+    parser.add_argument('-t', '--instance-type', default='i3.2xlarge',
+                        help='OPTIONAL. EC2 instance type to run the assembly '
+                        'on. Must provide an NVMe instance store volume. '
+                        '[DEFAULT: i3.2xlarge]')
+    parser.add_argument('-pg', '--placement-group', 
+                        help='OPTIONAL. EC2 cluster placement group to launch '
+                        'the assembly instance into.')
+
+    args = parser.parse_args()
+    if not args.samples_tsv and not (args.forward_read and args.reverse_read):
+        parser.error('Either --samples-tsv or both --forward-read and '
+                     '--reverse-read must be provided.')
+    if args.n_workers < 1:
+        parser.error('--n-workers must be at least 1.')
+
+    if args.samples_tsv:
+        try:
+            args.sample_pairs = parse_samples_file(args.samples_tsv)
+        except ValueError as e:
+            parser.error(str(e))
+
+        if not args.sample_pairs:
+            parser.error('No sequence read pairs found in %s.' % 
+                         args.samples_tsv)
+    else:
+        args.sample_pairs = [[args.forward_read, args.reverse_read]]
+
+    return args
+
+
+def parse_samples_file(samples_file):
+    """Parses a tab-delimited file of paired-end sequence reads, one 
+    forward and reverse pair per line.
+
+    Args:
+        samples_file (string): Path to the samples file.
+
+    Requires:
+        None
+
+    Returns:
+        list: A list of [forward, reverse] sequence read pairs. A ValueError
+            is raised for any line missing either read.
+    """
+    sample_pairs = []
+
+    with open(samples_file) as samples_fh:
+        for (line_num, line) in enumerate(samples_fh, 1):
+            if not line.strip():
+                continue
+
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 2 or not all(fields[:2]):
+                raise ValueError('%s line %s: expected a tab-separated forward '
+                                 'and reverse read, got "%s"' % 
+                                 (samples_file, line_num, line.strip()))
 
-    return parser.parse_args()    
+            sample_pairs.append(fields[:2])
+
+    return sample_pairs
 
 
 def generate_mapping_file(f_read, r_read, out_file):
@@ -131,92 +204,102 @@ def upload_and_process_input_files(ssh, instance, ssh_key, input_files):
 
     mapping_file = generate_mapping_file(input_files[0],
                                          input_files[1],
-                                         tempfile.NamedTemporaryFile(delete=False))
+                                         tempfile.NamedTemporaryFile(mode='w',
+                                                                     delete=False))
 
     scp = SCPClient(ssh.get_transport())
 
-    print "Transferring file %s to EC2 instance..." % input_files[0],
-    sys.stdout.flush()
+    logger.info("Transferring file %s to EC2 instance...", input_files[0])
     scp.put(input_files[0], remote_path='/mnt/data/')
-    print "    DONE"
-
-    print "Transferring file %s to EC2 instance..." % input_files[1],
-    sys.stdout.flush()
+    logger.info("Transferring file %s to EC2 instance...", input_files[1])
     scp.put(input_files[1], remote_path='/mnt/data/')
-    print "    DONE"
-
-    print "Transferring file %s to EC2 instance..." % mapping_file,
-    sys.stdout.flush()
+    logger.info("Transferring file %s to EC2 instance...", mapping_file)
     scp.put(mapping_file, remote_path='/mnt/data/zz00_input_locations.txt')
-    print "    DONE"
 
-    print "Extracting compressed sequence files...",
-    sys.stdout.flush()
+    logger.info("Extracting compressed sequence files...")
     (stdin, stdout, stderr) = ssh.exec_command('gunzip /mnt/data/*.gz')
     stdout.channel.recv_exit_status() ## Block until done
-    print "    DONE"
 
-    print "Running IMA_setup...",
-    sys.stdout.flush()
+    logger.info("Running IMA_setup...")
     (stdin, stdout, stderr) = ssh.exec_command('cd /mnt/data; '
                                                '/bin/bash -c /home/ec2-user/bin/IMA_setup')
     stdout.channel.recv_exit_status() ## Block again!
-    print "    DONE"
 
     os.remove(mapping_file)
 
     return scp
 
 
-def start_ec2_instance(ec2r, ec2c, ami_id):
-    """Starts up an AWS instance containing the IGS assembly pipeline
-    and configures the instance so that it is ready to run on HMP2 
-    metagenomics data.
+def start_ec2_instances(ec2r, ec2c, ami_id, instance_type='i3.2xlarge',
+                        placement_group=None, count=1):
+    """Starts up one or more AWS instances containing the IGS assembly 
+    pipeline and configures the instances so that they are ready to run on 
+    HMP2 metagenomics data.
 
     Args:
         ec2r (boto3.resource): The boto3 AWS EC2 resource interface.
         ec2c (boto3.client): The boto3 AWS EC2 client interface.
         ami_id (string): The AMI ID for the AWS image containing the requisite
             software.
+        instance_type (string): The EC2 instance type to launch. The type
+            must carry an NVMe instance store as this is where assembly 
+            data is staged.
+        placement_group (string): OPTIONAL. Name of a cluster placement group 
+            to launch the instance into.
+        count (int): The number of instances to start.
 
     Requires:
         None
 
     Returns:
-        The instance ID for the instance started                 
+        list: boto3 Instance representations of the instances started. If 
+            the instances fail to come up they are terminated before the 
+            error is raised.
 
     """
+    ## On Nitro instance types the root EBS volume is also an NVMe device 
+    ## so the instance store has to be found by its model rather than 
+    ## assumed to be /dev/nvme0n1. Nothing is formatted if none is found.
     userdata = """#cloud-config
         runcmd:
-            - [ sh, -c, "parted -s -a optimal /dev/nvme0n1 mklabel msdos mkpart primary 0% 100%" ]
-            - [ sh, -c, "mkfs /dev/nvme0n1p1" ]
-            - [ sh, -c, "mkdir -p /mnt/data" ]
-            - [ sh, -c, "mount /dev/nvme0n1p1 /mnt/data" ]
-            - [ sh, -c, "chmod ugo+rwx /mnt/data" ]
+            - [ sh, -c, "NVME=$(lsblk -dno NAME,MODEL | awk '/Instance Storage/ {print $1; found=1; exit} END {exit !found}') && parted -s -a optimal /dev/$NVME mklabel msdos mkpart primary 0% 100% && mkfs /dev/${NVME}p1 && mkdir -p /mnt/data && mount /dev/${NVME}p1 /mnt/data && chmod ugo+rwx /mnt/data" ]
     """ 
     waiter = ec2c.get_waiter('instance_running')
+
+    instance_args = {}
+    if placement_group:
+        instance_args['Placement'] = {'GroupName': placement_group}
  
     try:
-        print "Starting EC2 instance...",
-        sys.stdout.flush()
+        logger.info("Starting %s EC2 instance(s)...", count)
         response = ec2r.create_instances(ImageId=ami_id,
-                                         InstanceType='i3.2xlarge',
+                                         InstanceType=instance_type,
                                          KeyName='hmp2_keypair',
                                          SecurityGroupIds=['sg-dc6f67a9'],
                                          EbsOptimized=True,
                                          UserData=userdata,
-                                         MinCount=1,
-                                         MaxCount=1,
-                                         DryRun=False)
-        instance_id = response[0].id
-        waiter.wait(InstanceIds=[instance_id])
-        sleep(100)
-        print "    DONE"
+                                         MinCount=count,
+                                         MaxCount=count,
+                                         DryRun=False,
+                                         **instance_args)
     except ClientError as e:
-        print e        
+        logger.error(e)
+        raise
+
+    ## Once created the instances are billed until terminated so any 
+    ## failure (or interrupt) while waiting on them shuts them back down.
+    instance_ids = [instance.id for instance in response]
+    try:
+        waiter.wait(InstanceIds=instance_ids)
+        sleep(100)
+    except BaseException:
+        logger.exception("EC2 instance(s) %s failed to start; terminating", 
+                         ", ".join(instance_ids))
+        for instance in response:
+            instance.terminate()
+        raise
 
-    instance = ec2r.Instance(instance_id)
-    return instance
+    return [ec2r.Instance(instance_id) for instance_id in instance_ids]
 
 
 def start_assembly_pipeline(ssh):
@@ -232,14 +315,12 @@ def start_assembly_pipeline(ssh):
     Returns:
         int: The process ID for the pipeline run   
     """
-    print "Starting assembly pipeline...",
-    sys.stdout.flush()
+    logger.info("Starting assembly pipeline...")
     (stdin, stdout, stderr) = ssh.exec_command('cd /mnt/data; '
                                                'nohup /bin/bash '
                                                '-lc \'/mnt/data/003_run_assemblies.sh '
                                                '> /dev/null 2>&1 &\'')
     stdout.channel.recv_exit_status() ## Block again!
-    print "    DONE"
 
     (stdin, stdout, stderr) = ssh.exec_command('pgrep -f 003_run')
     pid = int(stdout.readline())
@@ -301,58 +382,134 @@ def download_assembly_files(ssh, scp, sample_base, output_dir):
             local_path=output_dir)
 
 
-def main(args):
-    input_files = [args.forward_read, args.reverse_read]
+def run_assembly(instance, ssh_key, input_files, output_dir):
+    """Runs the IGS assembly pipeline for one paired-end sample on the 
+    provided EC2 instance and downloads the results. The instance data 
+    directory is cleared afterwards so the instance can be re-used for the
+    next sample.
+
+    Args:
+        instance (boto3.EC2.Instance): boto3 Instance representation of EC2
+            instance.
+        ssh_key (string): Path to the public SSH keypair used to connect to the
+            EC2 instance.
+        input_files (list): The paired-end sequences to assemble.
+        output_dir (string): The base directory to download assembled 
+            metagenomes too.
+
+    Requires:
+        None
+
+    Returns:
+        string: Path to the directory containing the downloaded assembly.
+    """
     sample_base = (os.path.basename(input_files[0])
                      .split(os.extsep)[0]
                      .replace('_R1', ''))
-    output_dir = os.path.join(args.output_dir, sample_base)
+    sample_output_dir = os.path.join(output_dir, sample_base)
 
     try:
-       os.mkdir(output_dir)
-    except OSError, e:
-        if e.errno != os.errno.EEXIST:
+       os.mkdir(sample_output_dir)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
             raise
         pass       
 
-    ec2r = boto3.resource('ec2',
-                          aws_access_key_id=args.access_key,
-                          aws_secret_access_key=args.secret_key,
-                          region_name='us-east-1')
-    ec2c = boto3.client('ec2',
-                         aws_access_key_id=args.access_key,
-                         aws_secret_access_key=args.secret_key,
-                         region_name='us-east-1')
     ssh_client = SSHClient()
     ssh_client.set_missing_host_key_policy(AutoAddPolicy())
 
     try:
-        instance = start_ec2_instance(ec2r, ec2c, args.ami_id)
-        scp_client = upload_and_process_input_files(ssh_client, instance, args.ssh_key, input_files)
+        scp_client = upload_and_process_input_files(ssh_client, instance, ssh_key, input_files)
         assembly_pid = start_assembly_pipeline(ssh_client)
 
-        print "Running assembly...",
-        sys.stdout.flush()
+        logger.info("Running assembly of %s...", sample_base)
         is_running = True
         while is_running:
             sleep(180)
             is_running = is_assembly_running(ssh_client)
 
-        print "    DONE"
+        logger.info("Downloading assembly files for %s...", sample_base)
+        download_assembly_files(ssh_client, scp_client, sample_base, sample_output_dir)
+        logger.info("Assembly of %s complete.", sample_base)
+    finally:
+        ## Clear out the data directory so the instance can take another 
+        ## sample. This is only possible if we managed to connect and any 
+        ## failure here is logged rather than masking the original error.
+        transport = ssh_client.get_transport()
+        if transport is not None and transport.is_active():
+            try:
+                (stdin, stdout, stderr) = ssh_client.exec_command('rm -rf /mnt/data/*')
+                stdout.channel.recv_exit_status()
+            except Exception:
+                logger.exception("Failed to clear /mnt/data on %s after "
+                                 "assembling %s", instance.id, sample_base)
+        ssh_client.close()
+
+    return sample_output_dir
 
-        print "Downloading assembly files...",
-        sys.stdout.flush()
-        download_assembly_files(ssh_client, scp_client, sample_base, output_dir)
-        print "    DONE"
 
-        ## Shut-down the instance once we are done here
-        instance.terminate()
-    except Exception:
-        instance.terminate()        
-        raise
+def main(args):
+    sample_pairs = args.sample_pairs
+    n_workers = min(args.n_workers, len(sample_pairs))
+
+    session = boto3.Session(aws_access_key_id=args.access_key,
+                            aws_secret_access_key=args.secret_key,
+                            region_name='us-east-1')
+    ec2r = session.resource('ec2')
+    ec2c = session.client('ec2')
+
+    instances = start_ec2_instances(ec2r, ec2c, args.ami_id, 
+                                    args.instance_type, 
+                                    args.placement_group,
+                                    n_workers)
+    ## The instances are only shut down by the finally below so nothing can
+    ## sit between starting them and entering it.
+    try:
+        instances_lock = threading.Lock()
+        instance_pool = queue.Queue()
+        for instance in instances:
+            instance_pool.put(instance)
+
+        def _assemble_sample(input_files):
+            instance = instance_pool.get()
+            if instance is None:
+                instance_pool.put(None)
+                raise RuntimeError('No EC2 instance available to assemble', 
+                                   input_files)
+
+            try:
+                assembly_dir = run_assembly(instance, args.ssh_key, input_files, 
+                                            args.output_dir)
+            except Exception:
+                ## A failed sample may leave its instance unreachable or with 
+                ## a dirty data directory so rather than handing it to the next 
+                ## sample it is swapped out for a fresh instance. If no 
+                ## replacement can be started the pool is marked as exhausted so
+                ## waiting samples fail rather than block.
+                instance.terminate()
+                replacement = None
+                try:
+                    replacement = start_ec2_instances(ec2r, ec2c, args.ami_id,
+                                                      args.instance_type,
+                                                      args.placement_group, 1)[0]
+                    with instances_lock:
+                        instances.append(replacement)
+                finally:
+                    instance_pool.put(replacement)
+                raise
+
+            instance_pool.put(instance)
+            return assembly_dir
+
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            for assembly_dir in executor.map(_assemble_sample, sample_pairs):
+                logger.info("Assembly downloaded to %s", assembly_dir)
     finally:
-        instance.terminate()        
+        ## Shut-down the instance pool once we are done here
+        for instance in instances:
+            instance.terminate()        
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
     main(parse_cli_arguments())
\ No newline at end of file
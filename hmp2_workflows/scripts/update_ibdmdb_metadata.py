@@ -49,19 +49,44 @@ import sys
 import argparse
 import collections
 import datetime
-import math
 import os
+import re
 
-import glob2
 import numpy as np
 import pandas as pd
 
 import biobakery_workflows.utilities as bb_utils
 
+from hmp2_workflows.tasks.metadata import read_csv, read_cached_csv
 from hmp2_workflows.utils.misc import (parse_cfg_file, 
                                        get_sample_id_from_fname)
 
 
+_SITE_MAP = {'Cincinnati': 'H',
+             'Massachusetts General Hospital': 'M',
+             'Emory': 'E',
+             'MGH Pediatrics': 'P',
+             'Cedars-Sinai': 'C'}
+_SITE_NAME_MAP = dict((abbrev, site) for (site, abbrev) in _SITE_MAP.items())
+_INTERVAL_MAP = {'Screening Colonoscopy': 'SC',
+                 'Additional Biopsy': 'B',
+                 'Baseline (IBD and Healthy)': 'BL'}
+_PROJECT_TYPE_MAP = {'host_transcriptomics': 'HTX',
+                     'biopsy_16S': 'BP',
+                     'metatranscriptomics': 'MTX',
+                     'metagenomics': 'MGX',
+                     'viromics': 'MVX',
+                     'host_genome': 'HG',
+                     'methylome': 'RRBS',
+                     'serology': 'SER'}
+_SAMPLE_ID_COLS = ['Parent Sample A', 'Proteomics', 'MbX', 'Viromics', 
+                   'Site/Sub/Coll']
+_STUDYTRAX_SAMPLE_ID_COLS = ['bx_q5', 'bx_q6', 'bx_q7', 'bx_q9', 'bx_q13', 
+                             'bx_q14', 'bx_q15', 'bx_q17', 'bl_q4', 'bl_q5']
+_BIOPSY_DATA_TYPES = ['host_transcriptomics', 'biopsy_16S', 'methylome']
+_CATEGORICAL_COLS = ['data_type', 'Project', 'Research Project', 'IntervalName']
+_BLOOD_SAMPLE_ID_SUFFIX_RE = re.compile(r' 1|-1|[sS]1|\.1')
+
 
 def parse_cli_arguments():
     """Parses any command-line arguments passed into the script.
@@ -108,31 +133,15 @@ def parse_cli_arguments():
     parser.add_argument('-a', '--auxillary-metadata', action='append',
                         default=[], help='Additional auxillary metadata '
                         'to use in populating the HMP2 metadata table.')
+    parser.add_argument('-cd', '--cache-dir',
+                        help='OPTIONAL: Directory to keep parsed copies of '
+                        'the StudyTrax and Broad sample tracking files in. '
+                        'Defaults to a directory under the system temporary '
+                        'directory.')
     
     return parser.parse_args()
 
 
-def _add_previous_collection_date(dataframe):
-    """For each row in a dataframe takes the previous date of reception
-    and adds it as a new column to aid in computation of the week_num and
-    interval_days columns in our final metadata table.
-
-    Args:
-        dataframe (pandas.DataFrame): A dataframe containing all rows 
-            of metadata grouped together for a given subject.
-    
-    Requires:
-        None
-
-    Returns:
-        pandas.DataFrame: Modified grouped dataframe containing a new 
-            column containing a reference to the previous collection 
-            date when available.
-    """
-    dataframe['prev_coll_date'] = dataframe['Actual Date of Receipt'].shift()
-    return dataframe
-
-
 def parse_biopsy_dates(biopsy_dates):
     """Parses the supplementary Studytrax biopsy dates to allow for 
     attaching dates to any samples of type 'Screening Colonoscopy' or 
@@ -145,29 +154,27 @@ def parse_biopsy_dates(biopsy_dates):
         None
 
     Returns:
-        dict: A dictionary containing biopsy dates keyed on subject ID and 
-            sample type (i.e. Screening Colonoscopy)
+        pandas.Series: Biopsy week numbers indexed on subject ID and sample 
+            type (i.e. Screening Colonoscopy)
     """
-    biopsy_dict = {}
+    biopsy_df = pd.read_csv(biopsy_dates, comment='#', header=None,
+                            names=['subj_id', 'days', 'interval'],
+                            dtype='str', keep_default_na=False)
 
-    for line in open(biopsy_dates):
-        if line.startswith('#'):
-            continue
+    ## Days can be missing or listed as 'Days Unknown' in which case we 
+    ## leave the week number blank.
+    days = pd.to_numeric(biopsy_df['days'], errors='coerce')
+    biopsy_df['week_num'] = ((days.fillna(0) // 7).astype(int)
+                             .astype(object)
+                             .where(days.notnull(), ""))
 
-        week_num = ""
-        (subj_id, days, interval) = line.strip().split(',')
-        if days != "Days Unknown" and not days == "":
-            week_num = int(math.floor(int(days)/7))
-
-        biopsy_dict.setdefault(subj_id, {})
-        biopsy_dict[subj_id][interval] = week_num
-
-    return biopsy_dict
+    return (biopsy_df.drop_duplicates(subset=['subj_id', 'interval'], keep='last')
+                     .set_index(['subj_id', 'interval'])['week_num'])
 
 
 def get_collection_dates(metadata_df):
-    """Retrieves all collection dates for a given subject and returns a 
-    dicitonary key'd on subject.
+    """Retrieves all collection dates along with the first and previous 
+    collection date received for the same subject.
 
     Args:
         metadata_df (pandas.DataFrame): Broad sample tracking status 
@@ -176,16 +183,40 @@ def get_collection_dates(metadata_df):
         None
 
     Returns:
-        dict: A dictionary key'd on subject ID containing rows of metadata
-            containing collection dates per visit.
+        pandas.DataFrame: Rows of metadata containing collection dates per 
+            visit, sorted by date of receipt.
     """
-    collection_dict = dict((subj, df) for (subj, df) in 
-                           metadata_df.ix[:,'Subject':'Actual Date of Receipt']
-                           .sort_values(by='Actual Date of Receipt').groupby('Subject'))
-    collection_dict = dict((subj, _add_previous_collection_date(df))
-                            for (subj, df) in collection_dict.iteritems())
+    collection_df = (metadata_df.loc[:, 'Subject':'Actual Date of Receipt']
+                     .sort_values(by='Actual Date of Receipt'))
+
+    ## Previous date of reception for each collection is used to aid in 
+    ## computation of the week_num and interval_days columns. A stable sort 
+    ## on subject keeps each subject's collections in date order so both 
+    ## dates can be read straight off the sorted datetime array.
+    receipt_dates = collection_df['Actual Date of Receipt'].values
+    subject_codes = pd.factorize(collection_df['Subject'])[0]
+    prev_dates = np.full_like(receipt_dates, np.datetime64('NaT'))
+    initial_dates = prev_dates.copy()
 
-    return collection_dict
+    if len(subject_codes):
+        order = np.argsort(subject_codes, kind='mergesort')
+        sorted_codes = subject_codes[order]
+        sorted_dates = receipt_dates[order]
+
+        is_first = np.concatenate(([True], sorted_codes[1:] != sorted_codes[:-1]))
+        group_starts = np.maximum.accumulate(np.where(is_first, 
+                                                      np.arange(len(order)), 0))
+        has_subject = sorted_codes != -1
+
+        prev_dates[order] = np.where(is_first | ~has_subject, np.datetime64('NaT'),
+                                     np.roll(sorted_dates, 1))
+        initial_dates[order] = np.where(has_subject, sorted_dates[group_starts],
+                                        np.datetime64('NaT'))
+
+    collection_df['prev_coll_date'] = prev_dates
+    collection_df['initial_coll_date'] = initial_dates
+
+    return collection_df
 
 
 def get_all_sequence_files(input_dir, extensions):
@@ -204,99 +235,96 @@ def get_all_sequence_files(input_dir, extensions):
         list: A list containing all sequence files that will be used to 
             construct an IBDMDB metadata table.
     """
-    seq_files = [seq_file for seq_file in glob2.glob(os.path.join(input_dir, '**', '*'))
-                 if os.path.splitext(os.path.basename(seq_file))[-1] 
-                 in extensions]
+    extensions = frozenset(extensions)
+
+    seq_files = [os.path.join(dir_path, file_name)
+                 for (dir_path, dir_names, file_names) in os.walk(input_dir)
+                 for file_name in file_names
+                 if os.path.splitext(file_name)[-1] in extensions]
     
     return seq_files
 
 
-def get_project_id(row):
+def get_project_id(metadata_df):
     """Populates the 'Project' column in the HMP2 metadata table based off 
     whether or not data already exists or data can be pulled from an 
     auxillary column. 
 
     Args:
-        row (pandas.Series): Row of metadata from an HMP2 metadata table
+        metadata_df (pandas.DataFrame): HMP2 metadata table
 
     Requires:
         None
 
     Returns:
-        pandas.Series: Row of metadata with Project column populated.
+        pandas.Series: The Project ID for each row of metadata.
     """
-    project_id = row.get('Project')
-    type_mapping = {'host_transcriptomics': 'HTX',
-                    'biopsy_16S': 'BP',
-                    'metatranscriptomics': 'MTX',
-                    'metagenomics': 'MGX',
-                    'viromics': 'MVX',
-                    'host_genome': 'HG',
-                    'methylome': 'RRBS',
-                    'serology': 'SER' }
-
+    project_ids = (metadata_df['Site/Sub/Coll'] + '_' + 
+                   metadata_df['data_type'].map(_PROJECT_TYPE_MAP))
 
     ## This specific case is applicable to Proteomics data only but the 
     ## function can be expanded to handle other scenarios in the future
-    if pd.isnull(project_id) and not  pd.isnull(row.get('Job')):
-        project_id = row['Job']
-    else:
-        project_id = row.get('Site/Sub/Coll') + '_' + type_mapping.get(row.get('data_type'))
+    if 'Job' in metadata_df.columns:
+        use_job = metadata_df['Job'].notnull()
+        if 'Project' in metadata_df.columns:
+            use_job &= metadata_df['Project'].isnull()
 
-    return project_id
+        project_ids = project_ids.where(~use_job, metadata_df['Job'])
 
+    return project_ids
 
-def get_pdo_number(row):
+
+def get_pdo_number(metadata_df):
     """Populates the PDO number when it can be obtained from other pieces of 
     metadata.
 
     Args:
-        row (pandas.Series): Row of metadata from an HMP2 metadata table
+        metadata_df (pandas.DataFrame): HMP2 metadata table
 
     Requires:
         None
 
     Returns:
-        string: The corresponding PDO number for the given metadata row
+        pandas.Series: The corresponding PDO number for each metadata row
     """
-    pdo_num = row.get('PDO Number')
-    gid = row.get('Project')
+    pdo_nums = metadata_df['PDO Number'].astype(object)
+    data_types = metadata_df['data_type']
 
     ## This specific case is applicable to Proteomics data only but the 
     ## function can be expanded to handle other scenarios in the future
-    if (not isinstance(gid, float) and '.raw' in gid 
-        and row.get('data_type') == 'proteomics'):
-        filename = os.path.basename(gid).replace('_', '-')
-        batch_num = filename.split('-')[0]
-        
-        if batch_num.isdigit():
-            pdo_num = batch_num
-    elif row.get('data_type') == 'amplicon' and 'PDO' not in pdo_num:
-        pdo_num = "PDO-%s" % pdo_num
+    is_raw = ((data_types == 'proteomics') & 
+              metadata_df['Project'].astype(str).str.contains('.raw', regex=False))
+    batch_nums = (metadata_df.loc[is_raw, 'Project'].str.rsplit('/', n=1).str[-1]
+                                                    .str.replace('_', '-', regex=False)
+                                                    .str.split('-').str[0]
+                                                    .reindex(metadata_df.index))
+    has_batch = batch_nums.str.isdigit().fillna(False).astype(bool)
+
+    is_amplicon = ((data_types == 'amplicon') & pdo_nums.notnull() &
+                   ~pdo_nums.astype(str).str.contains('PDO', regex=False))
 
-    return pdo_num
+    return pd.Series(np.select([has_batch, is_amplicon],
+                               [batch_nums.values, ('PDO-' + pdo_nums.astype(str)).values],
+                               default=pdo_nums.values),
+                     index=metadata_df.index)
 
 
-def get_data_type(row):
+def get_data_type(metadata_df):
     """Populates the 'data_type' column in the HMP2 metadata table. Attempts
     guess what kind of data type the row of metadata is referencing based off 
     off of the values in other columns.
 
     Args:
-        row (pandas.Series): Row of metadata from an HMP2 metadata table
+        metadata_df (pandas.DataFrame): HMP2 metadata table
 
     Requires:
         None
 
     Returns:
-        pandas.Series: Row of metadata with data_type column populated
+        pandas.Series: The data type for each row of metadata
     """
-    data_type = None
-
-    if not pd.isnull(row.get('Job')):
-        data_type = 'proteomics'
-
-    return data_type
+    return pd.Series(np.where(metadata_df['Job'].notnull(), 'proteomics', None),
+                     index=metadata_df.index)
 
 
 def get_biopsy_site_sub_coll(row):
@@ -317,48 +345,55 @@ def get_biopsy_site_sub_coll(row):
     return site_sub_coll
 
 
-def _get_non_stool_site_sub_coll(row):
+def _get_non_stool_site_sub_coll(metadata_df):
     """For any non-stool collection StudyTrax entries generates Site/Sub/Coll
     ID's by using a combination of Project Specific ID, Site Name and 
     IntervalName.
+
+    Args:
+        metadata_df (pandas.DataFrame): StudyTrax rows of metadata.
+
+    Requires:
+        None
+
+    Returns:
+        pandas.Series: The Site/Sub/Coll ID for each row of metadata.
     """
-    interval_name = row.get('IntervalName')
-    subj_id = row.get('ProjectSpecificID')
-    site_name = row.get('SiteName')
-
-    site_mapping = {'Cincinnati': 'H',
-                    'Massachusetts General Hospital': 'M',
-                    'Emory': 'E',
-                    'MGH Pediatrics': 'P',
-                    'Cedars-Sinai': 'C'}
-    interval_mapping = {'Screening Colonoscopy': 'SC',
-                        'Additional Biopsy': 'B',
-                        'Baseline (IBD and Healthy)': 'BL'}
-
-    coll_num = "1"
-    if "follow-up" in interval_name.lower():
-        coll_num = interval_name.lower().replace('follow-up (month ', '').replace(')','')
-        interval_name_recode = "FU"
-    else:
-        interval_name_recode = interval_mapping.get(interval_name)
+    ## There are only a handful of distinct interval names so the collection
+    ## portion of the ID is built once per interval and broadcast back out.
+    (interval_codes, interval_names) = pd.factorize(metadata_df['IntervalName'])
+    interval_names = pd.Series(interval_names)
+    interval_names_lower = interval_names.str.lower()
+    is_follow_up = interval_names_lower.str.contains('follow-up', regex=False, na=False)
 
-    return site_mapping.get(site_name) + subj_id + 'C' + interval_name_recode + coll_num
+    coll_nums = (interval_names_lower.str.replace('follow-up (month ', '', regex=False)
+                                     .str.replace(')', '', regex=False)
+                                     .where(is_follow_up, '1'))
+    interval_name_recodes = interval_names.map(_INTERVAL_MAP).where(~is_follow_up, 'FU')
 
+    ## A missing interval name is coded as -1 so a trailing null picks it up
+    coll_suffixes = np.append((interval_name_recodes + coll_nums).values, np.nan)
+    coll_suffixes = pd.Series(coll_suffixes[interval_codes], index=metadata_df.index)
+
+    return (metadata_df['SiteName'].map(_SITE_MAP) + 
+            metadata_df['ProjectSpecificID'].astype(str) + 'C' + 
+            coll_suffixes)
 
-def resolve_dupe_ssc_ids(metadata_df):
-    prev_ssc = None
-    counter = 1
 
+def resolve_dupe_ssc_ids(metadata_df):
     ids = metadata_df['Site/Sub/Coll']
-    for (idx, row) in metadata_df[ids.isin(ids[ids.duplicated()])].sort_values("Site/Sub/Coll").iterrows():
-        ssc_id = row.get('Site/Sub/Coll')
-        if ssc_id != prev_ssc:
-            prev_ssc = ssc_id
-            counter = 1
-            continue
-
-        metadata_df.loc[idx, 'Site/Sub/Coll'] = ssc_id[:-1] + str(counter + 1)
-        counter = counter + 1
+
+    ## Rows without an ID (missing or unknown intervals) are left alone 
+    ## rather than renumbered as duplicates of each other.
+    dupe_ids = ids[ids.duplicated(keep=False)].dropna()
+
+    ## The first occurrence of each duplicated ID is left as is while each 
+    ## subsequent occurrence gets its collection number bumped by one.
+    dupe_counts = dupe_ids.groupby(dupe_ids, sort=True).cumcount()
+    dupe_counts = dupe_counts[dupe_counts > 0]
+
+    metadata_df.loc[dupe_counts.index, 'Site/Sub/Coll'] = (dupe_ids[dupe_counts.index].str.slice(0, -1) + 
+                                                           (dupe_counts + 1).astype(str))
     
     return metadata_df
 
@@ -379,19 +414,6 @@ def add_all_stool_collections(metadata_df, studytrax_df, broad_df):
         pandas.DataFrame: An updated dataframe containing all stool samples that 
         haven't been associated with a data type.
     """
-    site_mapping = {'Cincinnati': 'H',
-                    'Massachusetts General Hospital': 'M',
-                    'Emory': 'E',
-                    'MGH Pediatrics': 'P',
-                    'Cedars-Sinai': 'C'}
-
-    def _gen_site_sub_coll(row):
-        site_abbrev = site_mapping.get(row.get('SiteName'))
-        coll_num = row.get('IntervalName').replace('Stool Collection #', '')
-        subject_id = row.get('ProjectSpecificID')
-        return site_abbrev + subject_id + "C" + coll_num
-
-
     ## This is a temporary hack that allows us to loop in all the stool 
     ## samples that were received but did not have a corresponding data point
 
@@ -399,54 +421,104 @@ def add_all_stool_collections(metadata_df, studytrax_df, broad_df):
     ## is going to be similar to our Site/Sub/Coll ID's
     metadata_stool_df = metadata_df[metadata_df['IntervalName'].str.startswith('Stool')]
     studytrax_stool_df = studytrax_df[studytrax_df['IntervalName'].str.startswith('Stool')]
-    broad_subset_df = broad_df.filter(['Site/Sub/Coll', 'Actual Date of Receipt'])
+    broad_subset_df = (broad_df.filter(['Site/Sub/Coll', 'Actual Date of Receipt'])
+                               .dropna(subset=['Site/Sub/Coll']))
 
     tmp_stool_ids = ["%s_%s" % (x,y) for (x,y) in zip(metadata_stool_df['ProjectSpecificID'],
                                                       metadata_stool_df['IntervalSequence'])]
     tmp_stool_ids = list(set(tmp_stool_ids))
 
-    studytrax_stool_df['stool_id'] = studytrax_stool_df.apply(lambda row: "%s_%s" % (row['ProjectSpecificID'],
-                                                                                     row['IntervalSequence']), axis=1)
-    studytrax_stool_df['Site/Sub/Coll ID'] = studytrax_stool_df.apply(_gen_site_sub_coll, axis=1)
+    studytrax_stool_df['stool_id'] = (studytrax_stool_df['ProjectSpecificID'].astype(str) + '_' +
+                                      studytrax_stool_df['IntervalSequence'].astype(str))
+    studytrax_stool_df['Site/Sub/Coll ID'] = (studytrax_stool_df['SiteName'].map(_SITE_MAP) +
+                                              studytrax_stool_df['ProjectSpecificID'].astype(str) + 'C' +
+                                              studytrax_stool_df['IntervalName'].str.replace('Stool Collection #', '',
+                                                                                             regex=False))
     studytrax_noprod_df = studytrax_stool_df[-studytrax_stool_df['stool_id'].isin(tmp_stool_ids)]
     studytrax_noprod_df['data_type'] = "noproduct"
     studytrax_noprod_df['ProjectSpecificID'].astype('int')
-    studytrax_noprod_df = studytrax_noprod_df.merge(broad_subset_df, left_on='Site/Sub/Coll ID', right_on='Site/Sub/Coll', how='left')
+    studytrax_noprod_df = studytrax_noprod_df.merge(broad_subset_df, left_on='Site/Sub/Coll ID', right_on='Site/Sub/Coll', 
+                                                    how='left', validate='m:1', copy=False)
     studytrax_noprod_df['Site'] = studytrax_noprod_df['SiteName']
 
-    studytrax_noprod_df = studytrax_noprod_df.drop('stool_id', 1)
-    studytrax_noprod_df = studytrax_noprod_df.drop('Site/Sub/Coll', 1)
+    studytrax_noprod_df = studytrax_noprod_df.drop('stool_id', axis=1)
+    studytrax_noprod_df = studytrax_noprod_df.drop('Site/Sub/Coll', axis=1)
     
     metadata_df = pd.concat([metadata_df, studytrax_noprod_df], ignore_index=True)
 
     return metadata_df
 
 
-def _clean_blood_sample_ids(sample_id):
-    """Cleans up some of the funny looking sample IDs in the bl_q5 column 
-    used to map serology samples to the StudyTrax metadata
+def index_stool_visits(studytrax_df):
+    """Subsets StudyTrax clinical metadata down to the visits that have a 
+    stool sample ID (st_q4) and indexes them on this ID so they can be 
+    joined against the Broad sample tracking sheet. Should a stool sample ID
+    be recorded against more than one visit only the first visit is kept.
 
     Args:
-        sample_id (string): A sample ID in the Stuydtrax bl_q5 column to 
-            clean-up
+        studytrax_df (pandas.DataFrame): StudyTrax clinical metadata
 
-    Requires: None
+    Requires:
+        None
 
-    Returns: 
-        string: Cleaned sample ID.            
+    Returns:
+        pandas.DataFrame: StudyTrax stool visits indexed on stool sample ID.
     """
-    if not pd.isnull(sample_id):
-        sample_id = (sample_id.replace(' 1', '')
-                                .replace('-1', '')
-                                .replace('s1', '')
-                                .replace('S1', '')
-                                .replace('.1', ''))
+    stool_visits_df = (studytrax_df[studytrax_df['st_q4'].notnull()]
+                       .drop_duplicates('st_q4', keep='first')
+                       .set_index('st_q4', drop=False))
+    stool_visits_df.index.name = None
+
+    return stool_visits_df
 
-    return sample_id
+
+def _get_biopsy_rows(studytrax_df, sample_ids, biopsy_map, other_loc_cols,
+                     other_loc_map):
+    """Pulls out every StudyTrax row where one of the biopsy sample ID 
+    columns matches one of our sample ID's. All biopsy columns are matched in 
+    a single pass and each hit is labeled with the biopsy location of the 
+    column it was found in.
+
+    Args:
+        studytrax_df (pandas.DataFrame): StudyTrax clinical metadata
+        sample_ids (list): Sample ID's to search for.
+        biopsy_map (dict): Mapping of StudyTrax biopsy sample ID column to 
+            biopsy location.
+        other_loc_cols (dict): Mapping of StudyTrax biopsy sample ID column 
+            to the StudyTrax column holding its location code, for biopsies 
+            whose location is recorded separately.
+        other_loc_map (dict): Mapping of location code to biopsy location.
+
+    Requires:
+        None
+
+    Returns:
+        pandas.DataFrame: One row of StudyTrax metadata per matching biopsy 
+            sample ID with biopsy_location and External ID columns added.
+    """
+    biopsy_cols = list(biopsy_map)
+    id_values = studytrax_df[biopsy_cols].values
+
+    ## Walking the hits column-major keeps the rows grouped by biopsy column
+    (col_idx, row_idx) = np.nonzero(studytrax_df[biopsy_cols].isin(sample_ids).values.T)
+    src_cols = np.asarray(biopsy_cols, dtype=object)[col_idx]
+
+    locations = pd.Series(src_cols).map(biopsy_map).values
+    for (biopsy_col, loc_col) in other_loc_cols.items():
+        is_other = src_cols == biopsy_col
+        locations[is_other] = (pd.Series(studytrax_df[loc_col].values[row_idx[is_other]])
+                               .map(other_loc_map).values)
+
+    external_ids = (pd.Series(id_values[row_idx, col_idx], dtype=object)
+                    .str.replace('-', '', regex=False).values)
+
+    return studytrax_df.iloc[row_idx].assign(**{'biopsy_location': locations,
+                                                'External ID': external_ids})
 
 
 def get_metadata_rows(config, studytrax_df, sample_df, proteomics_df,
-                      data_type, sequence_files, pair_identifier):
+                      data_type, sequence_files, pair_identifier,
+                      studytrax_stool_df=None):
     """Extracts metadata from the supplied sources of metadata for the
     provided sequence files. 
 
@@ -460,6 +532,9 @@ def get_metadata_rows(config, studytrax_df, sample_df, proteomics_df,
             should be pulled for if available.
         pair_identifier (string): If working with paired-end files the 
             identifier to distinguish the first file from its pair.            
+        studytrax_stool_df (pandas.DataFrame): OPTIONAL. StudyTrax stool 
+            visits as returned by index_stool_visits. Built from 
+            studytrax_df if not provided.
 
     Requires:
         None
@@ -471,37 +546,29 @@ def get_metadata_rows(config, studytrax_df, sample_df, proteomics_df,
 
     sample_mapping = dict(zip(bb_utils.sample_names(sequence_files, pair_identifier),
                               map(get_sample_id_from_fname, sequence_files)))
-    sample_ids = sample_mapping.values()
+    sample_ids = pd.Index(list(sample_mapping.values()), dtype=object)
 
     if pair_identifier:
-       sample_ids = [sid.replace(pair_identifier, '') for sid in sample_ids]
+       sample_ids = sample_ids.str.replace(pair_identifier, '', regex=False)
 
-    sample_ids_techreps = [sid for (k, sid) in sample_mapping.iteritems() if "techrep" in k]
-    sample_ids = set(sample_ids) - set(sample_ids_techreps)
+    sample_ids_techreps = pd.Index([sid for (k, sid) in sample_mapping.items() if "techrep" in k],
+                                   dtype=object)
+    sample_ids = sample_ids.difference(sample_ids_techreps)
 
     data_type_mapping = config.get('dtype_mapping')
 
     ## Grab subset of Broad sample tracking spreadsheet
     sample_subset_df = pd.DataFrame()
     if data_type != "HTX":
-        sample_subset_df = sample_df[(sample_df['Parent Sample A'].isin(sample_ids)) |
-                                    (sample_df['Proteomics'].isin(sample_ids)) |
-                                    (sample_df['MbX'].isin(sample_ids)) |
-                                    (sample_df['Viromics'].isin(sample_ids)) |
-                                    (sample_df['Site/Sub/Coll']).isin(sample_ids)]
-
-    if sample_ids_techreps:
-        sample_ids_techreps = [sample_id.replace('_techrep', '') for sample_id 
-                               in sample_ids_techreps]
-        sample_subset_techreps = sample_df[(sample_df['Parent Sample A'].isin(sample_ids_techreps)) |
-                                 (sample_df['Proteomics'].isin(sample_ids_techreps)) |
-                                 (sample_df['MbX'].isin(sample_ids_techreps)) |
-                                 (sample_df['Viromics'].isin(sample_ids_techreps)) |
-                                 (sample_df['Site/Sub/Coll']).isin(sample_ids_techreps)]
-
-        sample_subset_techreps['External ID'] = sample_subset_techreps['Parent Sample A'].map(lambda sid: sid.replace('-', '') + "_TR")
-        sample_subset_techreps['External ID'] = sample_subset_techreps.apply(lambda row: row.get('Site/Sub/Coll')[0] + 
-                                                                                         row.get('External ID'), axis=1)
+        sample_subset_df = sample_df[sample_df[_SAMPLE_ID_COLS].isin(sample_ids).any(axis=1)]
+
+    if not sample_ids_techreps.empty:
+        sample_ids_techreps = sample_ids_techreps.str.replace('_techrep', '', regex=False)
+        sample_subset_techreps = sample_df[sample_df[_SAMPLE_ID_COLS].isin(sample_ids_techreps).any(axis=1)]
+
+        sample_subset_techreps['External ID'] = (sample_subset_techreps['Site/Sub/Coll'].str[0] +
+                                                 sample_subset_techreps['Parent Sample A'].str.replace('-', '', regex=False) +
+                                                 "_TR")
         sample_subset_df = pd.concat([sample_subset_df, sample_subset_techreps],
                                      ignore_index=True)
 
@@ -525,40 +592,28 @@ def get_metadata_rows(config, studytrax_df, sample_df, proteomics_df,
                           'bx_q7': 'Other Inflamed',
                           'bx_q9': 'Non-inflamed'}
 
-            new_meta_dfs = []
-            for (studytrax_col, location) in biopsy_map.iteritems():
-                new_meta_df = studytrax_df[studytrax_df[studytrax_col].isin(sample_ids)]
-                new_meta_df['biopsy_location'] = location
-                new_meta_df['External ID'] = new_meta_df[studytrax_col].map(lambda sid: sid.replace('-', ''))
-
-                if not new_meta_df['biopsy_location'].empty:
-                    if location == "Other Inflamed":
-                        new_loc_col = "bx_q8"
-                    elif location == "Non-inflamed":
-                        new_loc_col = "bx_q10"
-                    if not location in ['Rectum', 'Ileum']:
-                        new_meta_df['biopsy_location'] = [other_loc_map.get(x) for x in new_meta_df[new_loc_col]]
-
-                new_meta_dfs.append(new_meta_df)
+            new_meta_dfs = [_get_biopsy_rows(studytrax_df, sample_ids, biopsy_map,
+                                             {'bx_q7': 'bx_q8', 'bx_q9': 'bx_q10'},
+                                             other_loc_map)]
 
             if data_type == "RRBS":
                 blood_df = studytrax_df[studytrax_df['bl_q4'].isin(sample_ids)]
-                blood_df['External ID'] = blood_df['bl_q4'].map(lambda sid: sid.replace('-', ''))
+                blood_df['External ID'] = blood_df['bl_q4'].str.replace('-', '', regex=False)
                 new_meta_dfs.append(blood_df)
 
             metadata_df = pd.concat([sample_subset_df] + new_meta_dfs, ignore_index=True)
             metadata_df = metadata_df.drop_duplicates(subset=['External ID', 'biopsy_location'], keep='first')
-            metadata_df['Site/Sub/Coll'] = metadata_df.apply(_get_non_stool_site_sub_coll, axis=1)
+            metadata_df['Site/Sub/Coll'] = _get_non_stool_site_sub_coll(metadata_df)
             resolve_dupe_ssc_ids(metadata_df)
         elif data_type == "HG":
             studytrax_col = "bl_q4"
             blood_df = studytrax_df[studytrax_df[studytrax_col].isin(sample_ids)]
-            blood_df['External ID'] = blood_df[studytrax_col].map(lambda sid: sid.replace('-', ''))
+            blood_df['External ID'] = blood_df[studytrax_col].str.replace('-', '', regex=False)
  
             metadata_df = pd.concat([sample_subset_df, blood_df],
                                     ignore_index=True)
  
-            metadata_df['Site/Sub/Coll'] = metadata_df.apply(_get_non_stool_site_sub_coll, axis=1)
+            metadata_df['Site/Sub/Coll'] = _get_non_stool_site_sub_coll(metadata_df)
             resolve_dupe_ssc_ids(metadata_df)
         elif data_type == "SER":
             new_metadata_dfs = []
@@ -566,15 +621,16 @@ def get_metadata_rows(config, studytrax_df, sample_df, proteomics_df,
 
             # We get some really weird stuff going on in the studytrax mapping column here so let's 
             # clean things up first
-            studytrax_df['bl_q5'] = studytrax_df['bl_q5'].map(_clean_blood_sample_ids)
+            studytrax_df['bl_q5'] = studytrax_df['bl_q5'].str.replace(_BLOOD_SAMPLE_ID_SUFFIX_RE, 
+                                                                      '', regex=True)
 
-            for (col, label) in studytrax_cols.iteritems():
+            for (col, label) in studytrax_cols.items():
                 new_metadata_df = studytrax_df[studytrax_df[col].isin(sample_ids)]
                 new_metadata_df['External ID'] = new_metadata_df[col]
                 new_metadata_dfs.append(new_metadata_df)
 
             metadata_df = pd.concat([sample_subset_df] + new_metadata_dfs, ignore_index=True)
-            metadata_df['Site/Sub/Coll'] = metadata_df.apply(_get_non_stool_site_sub_coll, axis=1)
+            metadata_df['Site/Sub/Coll'] = _get_non_stool_site_sub_coll(metadata_df)
             resolve_dupe_ssc_ids(metadata_df)
         elif data_type == "16SBP":
             biopsy_map = {'bx_q13': 'Rectum',
@@ -582,33 +638,25 @@ def get_metadata_rows(config, studytrax_df, sample_df, proteomics_df,
                           'bx_q15': 'Other Inflamed',
                           'bx_q17': 'Non-inflamed'}
 
-            biopsy_dfs = []
-            for (studytrax_col, location) in biopsy_map.iteritems():
-                biopsy_df = studytrax_df[studytrax_df[studytrax_col].isin(sample_ids)]
-                biopsy_df['biopsy_location'] = location
-                biopsy_df['External ID'] = biopsy_df[studytrax_col].map(lambda sid: sid.replace('-', ''))
-
-                if not biopsy_df['biopsy_location'].empty:
-                    if location == "Other Inflamed":
-                        new_loc_col = "bx_q16"
-                    elif location == "Non-inflamed":
-                        new_loc_col = "bx_q18"
-                        
-                    if not location in ['Rectum', 'Ileum']:
-                        biopsy_df['biopsy_location'] = [other_loc_map.get(x) for x in biopsy_df[new_loc_col]]
-
-                biopsy_dfs.append(biopsy_df)
+            biopsy_dfs = [_get_biopsy_rows(studytrax_df, sample_ids, biopsy_map,
+                                           {'bx_q15': 'bx_q16', 'bx_q17': 'bx_q18'},
+                                           other_loc_map)]
 
             metadata_df = pd.concat([sample_subset_df] + biopsy_dfs, ignore_index=True)
             metadata_df.drop_duplicates(subset=['External ID', 'biopsy_location'], keep='first')
-            metadata_df['Site/Sub/Coll'] = metadata_df.apply(_get_non_stool_site_sub_coll, axis=1)
+            metadata_df['Site/Sub/Coll'] = _get_non_stool_site_sub_coll(metadata_df)
             resolve_dupe_ssc_ids(metadata_df)
 
     else:
-        metadata_df = sample_subset_df.merge(studytrax_df,
-                                             left_on='Parent Sample A',
-                                             right_on='st_q4',
-                                             how='left')
+        if studytrax_stool_df is None:
+            studytrax_stool_df = index_stool_visits(studytrax_df)
+
+        metadata_df = sample_subset_df.join(studytrax_stool_df,
+                                            on='Parent Sample A',
+                                            how='left',
+                                            lsuffix='_x',
+                                            rsuffix='_y')
+        metadata_df.reset_index(drop=True, inplace=True)
 
         ## We sometimes get a situation where our studytrax metadata is missing 
         ## some of the proteomics sample ID's so we need to make sure we 
@@ -626,17 +674,20 @@ def get_metadata_rows(config, studytrax_df, sample_df, proteomics_df,
             sample_filter_df = sample_filter_df[['Parent Sample A', 'Proteomics']]
 
             proteomics_df['sample_ids'] = proteomics_df['Dataset'].replace(sample_mapping)
-            proteomics_df['PDO Number'] = proteomics_df['Dataset'].map(lambda did: did.replace('-', '_')
-                                                                                      .split('_')[0])
+            proteomics_df['PDO Number'] = (proteomics_df['Dataset'].str.replace('-', '_', regex=False)
+                                                                   .str.split('_').str[0])
             proteomics_df = sample_filter_df.merge(proteomics_df,
                                                    left_on='Proteomics',
                                                    right_on='sample_ids',
-                                                   how='right')
-            proteomics_df = proteomics_df.drop('Proteomics', 1)
+                                                   how='right',
+                                                   validate='1:m',
+                                                   copy=False)
+            proteomics_df = proteomics_df.drop('Proteomics', axis=1)
 
             metadata_df = metadata_df.merge(proteomics_df,
                                             on='Parent Sample A',
-                                            how='left')
+                                            how='left',
+                                            copy=False)
             metadata_df['External ID'] = None                                            
     
     ## Now if we have techreps in our samples we need to add them in.
@@ -661,69 +712,66 @@ def remove_columns(metadata_df, drop_cols):
     metadata_cols = metadata_df.columns.tolist()
     to_drop = set(metadata_cols).intersection(set(drop_cols))
 
-    return metadata_df.drop(to_drop, 1)
+    return metadata_df.drop(to_drop, axis=1)
 
 
-def generate_external_id(row):
-    """Retrieves or produces the external ID for the given row of metadata. 
+def generate_external_id(metadata_df):
+    """Retrieves or produces the external ID for each row of metadata. 
     An external ID is an identifier that the contributor of a given sample 
     can identify their samples via.
 
     Args:
-        row (pandas.Series): A row of metadata from our metadata table.
+        metadata_df (pandas.DataFrame): Rows of metadata from our metadata 
+            table.
 
     Requires:
         None
 
     Returns:
-        string: The external ID for the given row of metadata
+        pandas.Series: The external ID for each row of metadata
     """
-    stool_id = row['st_q4']
-    blood_id = row['bl_q4']
-    external_id  = row.get('External ID')
-    base_id = None
-
-    if row.get('data_type') != "noproduct":
-        if not pd.isnull(external_id):
-            base_id = external_id
-        elif not pd.isnull(stool_id):
-            base_id = stool_id
-        elif not pd.isnull(blood_id):
-            base_id = blood_id
-        else:
-            raise Exception("Could not generate External ID:", row)
-
-        site_sub_coll = row['Site/Sub/Coll ID']
-        row['External ID'] = site_sub_coll[0] + base_id.replace('-', '')
-        #eturn site_sub_coll[0] + base_id.replace('-', '')
-        
-    return row
-
-
-def fix_site_sub_coll_id(row, site_mapping):
+    if 'External ID' in metadata_df.columns:
+        external_ids = metadata_df['External ID']
+    else:
+        external_ids = pd.Series(None, index=metadata_df.index, dtype=object)
+
+    is_product = metadata_df['data_type'] != "noproduct"
+    base_ids = (external_ids.astype(object)
+                .combine_first(metadata_df['st_q4'].astype(object))
+                .combine_first(metadata_df['bl_q4'].astype(object)))
+
+    missing_ids = is_product & base_ids.isnull()
+    if missing_ids.any():
+        raise Exception("Could not generate External ID:", metadata_df[missing_ids])
+
+    site_abbrevs = metadata_df['Site/Sub/Coll ID'].str[0]
+    return (site_abbrevs + base_ids.str.replace('-', '', regex=False)).where(is_product, 
+                                                                           external_ids)
+
+
+def fix_site_sub_coll_id(metadata_df, site_mapping):
     """Adds the SiteName abbreviation to the Site/Sub/Coll ID in the instances
     where it is not present. This abbreviation is necessary to de-dupe rows.
 
     Args:
-        row (pandas.Series): A row of metadata from our metadata table.
+        metadata_df (pandas.DataFrame): Rows of metadata from our metadata 
+            table.
         site_mapping (dict): The mapping of Site Name to Site abbreviation
 
     Requires:
         None
 
     Returns:
-        string: The completed Site/Sub/Coll ID
+        pandas.Series: The completed Site/Sub/Coll ID's
     """
-    site_sub_coll_id = row['Site/Sub/Coll ID']
-    site_abbrev = site_sub_coll_id[0]
-
-    if site_abbrev.isdigit():
-        site_sub_coll_id = site_mapping.get(row['SiteName']) + site_sub_coll_id
+    site_sub_coll_ids = metadata_df['Site/Sub/Coll ID']
+    missing_site = site_sub_coll_ids.str.match(r'\d', na=False)
 
-    return site_sub_coll_id
+    return site_sub_coll_ids.where(~missing_site, 
+                                   metadata_df['SiteName'].map(site_mapping) + site_sub_coll_ids)
 
 
-def fill_visit_nums(row):
+def fill_visit_nums(metadata_df):
     """In the case of a missing visit number in a metadata row will attempt
     to parse the visit number from the Site/Sub/Coll ID. This ID should 
     encapsulate the visit number in the following format: XXXXC<VISIT_NUM>
@@ -731,34 +779,34 @@ def fill_visit_nums(row):
     Example: C3010C9
 
     Args:
-        row (pandas.Series): A row of metadata from our metadata table.
+        metadata_df (pandas.DataFrame): Rows of metadata from our metadata 
+            table.
 
     Requires:
         None
 
     Returns:
-        string: The corresponding visit number for the given row.
+        pandas.Series: The corresponding visit number for each row.
     """
-    site_sub_coll_id = row['Site/Sub/Coll ID']
-    visit_num = row['visit_num']
-    data_type  = row['data_type']
+    visit_nums = metadata_df['visit_num']
+    missing_visit = (visit_nums.isnull() & 
+                     ~metadata_df['data_type'].isin(_BIOPSY_DATA_TYPES + ['host_genome']))
 
-    if pd.isnull(visit_num) and data_type not in ['host_transcriptomics', 'host_genome',
-                                                  'biopsy_16S', 'methylome']:
-        visit_num = site_sub_coll_id.split('C')[-1]
-    
-    return visit_num
+    return visit_nums.where(~missing_visit, 
+                            metadata_df['Site/Sub/Coll ID'].str.split('C').str[-1])
 
 
-def generate_collection_statistics(metadata_df, collection_dict, biopsy_dates=None):
+def generate_collection_statistics(metadata_df, collection_df, biopsy_dates=None):
     """Generates the week_num and interval_days columns which contain
     the number of weeks between the past collection date and days between 
     the last collection date respectively.
 
     Args:
         metadata_df (pandas.DataFrame): DataFrame containing all metadata
-        collection_dict (dict): Dictionary containing collection dates for 
-            each subject grouped by subject ID.
+        collection_df (pandas.DataFrame): Collection dates for each subject
+            as returned by get_collection_dates.
+        biopsy_dates (pandas.Series): OPTIONAL. Week numbers for each 
+            subject's biopsy visits as returned by parse_biopsy_dates.
 
     Requires:
         None
@@ -767,128 +815,135 @@ def generate_collection_statistics(metadata_df, collection_dict, biopsy_dates=No
         pandas.DataFrame: Updated DataFrame with week_num and interval_days
             columns populated for each row.
     """
-    def _add_collection_columns(row):
-        """Adds the week_num and interval_days columns to the provided row 
-        of a dataframe.
+    data_types = metadata_df['data_type']
+    ssc_ids = metadata_df['Site/Sub/Coll ID']
+
+    is_biopsy = data_types.isin(_BIOPSY_DATA_TYPES)
+    is_stool = ~is_biopsy & (data_types != 'host_genome')
+
+    metadata_df['Participant ID'] = ssc_ids.str.slice(0, 5)
+    subject_ids = pd.to_numeric(ssc_ids.str.slice(1, 5), errors='coerce')
+
+    ## Biopsies take their week number from the biopsy dates file unless 
+    ## they were taken at the baseline visit.
+    interval_names = metadata_df['IntervalName']
+    is_baseline = is_biopsy & interval_names.str.contains('Baseline', regex=False, na=False)
+    is_dated = (is_biopsy & ~is_baseline & 
+                ~interval_names.str.contains('Follow', regex=False, na=False))
+
+    metadata_df['week_num'] = metadata_df['week_num'].astype(object)
+    metadata_df.loc[is_baseline, 'week_num'] = "0"
+    if is_dated.any() and biopsy_dates is not None:
+        biopsy_keys = pd.MultiIndex.from_arrays([subject_ids[is_dated].astype(int).astype(str),
+                                                 interval_names[is_dated]])
+        metadata_df.loc[is_dated, 'week_num'] = biopsy_dates.reindex(biopsy_keys).values
+
+    metadata_df.loc[is_stool, 'Participant ID'] = ssc_ids[is_stool].str.rsplit('C', n=1).str[0]
+
+    sites = metadata_df['Site']
+    site_names = metadata_df['SiteName']
+    metadata_df.loc[is_stool, 'Site'] = sites.combine_first(site_names)[is_stool]
+    metadata_df.loc[is_stool, 'SiteName'] = site_names.combine_first(sites)[is_stool]
+
+    ## Stool collections are timed relative to the first collection received
+    ## for the subject and to the collection received before them.
+    receipt_dates = metadata_df['Actual Date of Receipt']
+    needs_week = is_stool & metadata_df['week_num'].isnull() & receipt_dates.notnull()
+
+    if needs_week.any():
+        coll_df = (collection_df.assign(Subject=collection_df['Subject'].astype(float),
+                                        visit_num=collection_df['Collection #'].astype(float))
+                                .drop_duplicates(subset=['Subject', 'visit_num'], keep='first'))
+
+        ## Both lookups are unique per key so plain Series lookups do the job
+        ## of a merge without building a joined frame.
+        initial_dates = coll_df.drop_duplicates(subset='Subject').set_index('Subject')['initial_coll_date']
+        prev_dates = coll_df.set_index(['Subject', 'visit_num'])['prev_coll_date']
+
+        visit_subjects = subject_ids[needs_week].astype(float)
+        visit_nums = pd.to_numeric(metadata_df.loc[needs_week, 'visit_num']).astype(float)
+
+        visit_dates = pd.DataFrame({'initial_coll_date': visit_subjects.map(initial_dates)})
+        visit_dates['prev_coll_date'] = (prev_dates.reindex(pd.MultiIndex.from_arrays([visit_subjects, 
+                                                                                        visit_nums]))
+                                                   .values)
+        visit_dates['prev_coll_date'] = visit_dates['prev_coll_date'].combine_first(visit_dates['initial_coll_date'])
+
+        metadata_df.loc[needs_week, 'week_num'] = ((receipt_dates[needs_week] - 
+                                                    visit_dates['initial_coll_date']).dt.days // 7)
+        metadata_df.loc[needs_week, 'interval_days'] = (receipt_dates[needs_week] - 
+                                                        visit_dates['prev_coll_date']).dt.days
 
-        Args:
-            row (pandas.Series): A row of the metadata dataframe
-    
-        Requires:
-            None
-
-        Returns:
-            pandas.Series: Modified row containing populated week_num and 
-                interval_day columns.
-        """
-        data_type = row['data_type']
-
-        ## Sticking this in here for the time being...
-        participant_id = row['Site/Sub/Coll ID'][:5]
-        row['Participant ID'] = participant_id
-        subject_id = int(row['Participant ID'][1:])
-        
-        if data_type in ['host_transcriptomics', 'biopsy_16S', 'methylome']:
-            interval_name = row['IntervalName']
-            
-            if "Baseline" in interval_name:
-                row['week_num'] = "0"
-            elif not  "Follow" in interval_name:
-                row['week_num'] = biopsy_dates[str(subject_id)][interval_name]
-        elif data_type != 'host_genome':
-            visit_num = row['visit_num']
-            receipt_date = row['Actual Date of Receipt']
-
-            ## Sticking this in here for the time being...
-            participant_id = row['Site/Sub/Coll ID'].rsplit('C', 1)[0]
-            row['Participant ID'] = participant_id
-
-            if pd.isnull(row['Site']):
-                row['Site'] = row['SiteName']
-            elif pd.isnull(row['SiteName']):
-                row['SiteName'] = row['Site']
-
-            if pd.isnull(row['week_num']) and not pd.isnull(receipt_date):
-                #print row
-                collection_dates = collection_dict.get(subject_id)
-                #print "DEBUG:", collection_dates, visit_num
-                initial_visit_date = collection_dates.iloc[0]['Actual Date of Receipt']
-                subj_collection_row = collection_dates[collection_dates['Collection #']
-                                                       == int(visit_num)]
-                prev_visit_date = subj_collection_row['prev_coll_date'].values[0]
-
-                if pd.isnull(prev_visit_date):
-                    prev_visit_date = initial_visit_date
-
-                row['week_num'] = (receipt_date - initial_visit_date).days / 7
-                row['interval_days'] = (receipt_date - prev_visit_date).days
-
-        return row
-
-    metadata_df = metadata_df.apply(_add_collection_columns, axis=1)
     metadata_df = add_biopsy_visit_num(metadata_df)
 
     return metadata_df
 
 
 def add_biopsy_visit_num(metadata_df):
+    """Assigns visit numbers to biopsy rows that are missing one by borrowing 
+    the visit number of the subject's non-biopsy collection whose week number 
+    is closest to the biopsy's. Biopsies without a week number, or whose 
+    subject has no other collections, are assigned to the first visit.
+
+    Args:
+        metadata_df (pandas.DataFrame): DataFrame containing all metadata
+
+    Requires:
+        None
+
+    Returns:
+        pandas.DataFrame: Updated DataFrame with visit_num populated for 
+            biopsy rows.
     """
-    """
-    for (idx, row) in metadata_df[metadata_df['data_type'].isin(['host_transcriptomics', 'biopsy_16S', 'methylome'])].iterrows():
-        week_num = row.get('week_num')
-        visit_num = row.get('visit_num')
-        participant_id = row.get('Participant ID')
-
-        if not pd.isnull(visit_num):
-            continue
-
-        if pd.isnull(week_num) or week_num == '':
-            visit_num = 1
-        else:
-            ## Do we have an exact match somewhere?
-            match = metadata_df.loc[(metadata_df['Participant ID'] == participant_id) &
-                                    (metadata_df['week_num'] == week_num) &
-                                    (-metadata_df['data_type'].isin(['host_transcriptomics', 'biopsy_16S', 'methylome']))]
-
-            if not match.empty:
-                visit_num = match.get('visit_num').values[0]
-            else:
-                ## If not then we are going to try to get as close as possible here...
-                subject_rows = metadata_df.loc[(metadata_df['Participant ID'] == participant_id) &
-                                               (-metadata_df['data_type'].isin(['host_transcriptomics', 'biopsy_16S', 'methylome']))]
-                subject_rows['week_num'] = pd.to_numeric(subject_rows['week_num'])
-                matches = subject_rows.iloc[(subject_rows['week_num']-float(week_num)).abs().argsort()[:2]]
-
-                if matches.empty:
-                    visit_num = 1
-                else:
-                    visit_num = matches['visit_num'].values[0]
+    is_biopsy = metadata_df['data_type'].isin(_BIOPSY_DATA_TYPES)
+    needs_visit = is_biopsy & metadata_df['visit_num'].isnull()
+
+    if not needs_visit.any():
+        return metadata_df
+
+    week_nums = pd.to_numeric(metadata_df['week_num'], errors='coerce').astype(float)
+    biopsy_df = pd.DataFrame({'row_idx': metadata_df.index[needs_visit],
+                              'Participant ID': metadata_df.loc[needs_visit, 'Participant ID'].values,
+                              'week_num': week_nums[needs_visit].values})
+    visits_df = pd.DataFrame({'Participant ID': metadata_df.loc[~is_biopsy, 'Participant ID'].values,
+                              'week_num': week_nums[~is_biopsy].values,
+                              'visit_num': metadata_df.loc[~is_biopsy, 'visit_num'].values,
+                              'has_visit': True})
+
+    ## An exact week match is just the nearest match at a distance of zero
+    matches_df = pd.merge_asof(biopsy_df.dropna(subset=['week_num', 'Participant ID'])
+                                        .sort_values('week_num'),
+                               visits_df.dropna(subset=['week_num', 'Participant ID'])
+                                        .sort_values('week_num'),
+                               on='week_num',
+                               by='Participant ID',
+                               direction='nearest')
+    matches_df = matches_df[matches_df['has_visit'].notnull()]
+
+    visit_nums = pd.Series(1, index=biopsy_df['row_idx'], dtype=metadata_df['visit_num'].dtype)
+    visit_nums[matches_df['row_idx'].values] = matches_df['visit_num'].values
+    metadata_df.loc[visit_nums.index, 'visit_num'] = visit_nums.values
 
-        row['visit_num'] = visit_num
-        metadata_df.loc[idx] = row
-    
     return metadata_df
 
 
 def fix_site_name(metadata_nosite_df):
-    """
-    """
-    site_mapping = {'H': 'Cincinnati',
-                    'M': 'Massachusetts General Hospital',
-                    'E': 'Emory',
-                    'P': 'MGH Pediatrics',
-                    'C': 'Cedars-Sinai'}
+    """Fills in the Site and SiteName columns using the site abbreviation 
+    that leads the Site/Sub/Coll ID.
 
-    def _fix_site_name(row):
-        site_sub_coll = row.get('Site/Sub/Coll ID')
-        site_abbrev = site_sub_coll[0]
-        row['SiteName'] = site_mapping.get(site_abbrev)
-        row['Site'] = row['SiteName']
-        return row
+    Args:
+        metadata_nosite_df (pandas.DataFrame): Rows of metadata missing site
+            information.
 
-    metadata_nosite_df = metadata_nosite_df.apply(_fix_site_name, axis=1)
+    Requires:
+        None
+
+    Returns:
+        pandas.DataFrame: The metadata rows with Site and SiteName populated.
+    """
+    site_names = metadata_nosite_df['Site/Sub/Coll ID'].str[0].map(_SITE_NAME_MAP)
 
-    return metadata_nosite_df
+    return metadata_nosite_df.assign(SiteName=site_names, Site=site_names)
 
 
 def reorder_columns(metadata_df, cols_to_move):
@@ -907,11 +962,10 @@ def reorder_columns(metadata_df, cols_to_move):
     Returns:
         pandas.DataFrame: DataFrame with new ordering.
     """
-    metadata_cols = metadata_df.columns.tolist()
-    metadata_cols = [col for col in metadata_cols 
-                     if col not in cols_to_move]
-    metadata_cols = cols_to_move + metadata_cols
-    metadata_df = metadata_df[metadata_cols]
+    move_cols = set(cols_to_move)
+    metadata_cols = [col for col in metadata_df.columns 
+                     if col not in move_cols]
+    metadata_df = metadata_df[list(cols_to_move) + metadata_cols]
 
     return metadata_df
 
@@ -934,16 +988,17 @@ def add_baseline_metadata_values(metadata_df, studytrax_df, baseline_columns):
         pandas.DataFrame: DataFrame containing metadata with baseline columns
             filled in.                    
     """
-    metadata_df.set_index('ProjectSpecificID', inplace=True)
+    baseline_df = (studytrax_df[studytrax_df['IntervalName'] == 'Baseline (IBD and Healthy)']
+                   .filter(['ProjectSpecificID'] + list(baseline_columns)))
+    baseline_df['ProjectSpecificID'] = pd.to_numeric(baseline_df['ProjectSpecificID'])
 
-    for col in baseline_columns:
-        baseline_df = studytrax_df[(studytrax_df['IntervalName'] == 'Baseline (IBD and Healthy)') &
-                                   (studytrax_df[col].notnull())].filter(['ProjectSpecificID', col])
-        baseline_df[col].apply(lambda x: x.split("(")[0])
-        baseline_df['ProjectSpecificID'] = pd.to_numeric(baseline_df['ProjectSpecificID'])
-        baseline_df.set_index('ProjectSpecificID', inplace=True)
-        metadata_df.update(baseline_df)
+    ## A subject can have more than one baseline row with each column only 
+    ## filled in on one of them so collapse these down to the first value 
+    ## recorded for each column.
+    baseline_df = baseline_df.groupby('ProjectSpecificID').first()
 
+    metadata_df.set_index('ProjectSpecificID', inplace=True)
+    metadata_df.update(baseline_df)
     metadata_df.reset_index(inplace=True)
     return metadata_df        
 
@@ -965,8 +1020,9 @@ def get_no_sequence_metadata(metadata_df, clinical_df):
         pandas.DataFrame: DataFrame containing any clinical metadata not 
             associated with a specific sequence file.                    
     """
-    sample_ids = [sid[1:3] + '-' + sid[3:] for sid in metadata_df['External ID']]
-    clinical_noseq_df = clinical_df[-clinical_df['st_q4'].isin(sample_ids)]
+    external_ids = metadata_df['External ID'].dropna()
+    sample_ids = external_ids.str.slice(1, 3) + '-' + external_ids.str.slice(3)
+    clinical_noseq_df = clinical_df[~clinical_df['st_q4'].isin(sample_ids)]
 
     return clinical_noseq_df
 
@@ -974,10 +1030,21 @@ def get_no_sequence_metadata(metadata_df, clinical_df):
 def main(args):
     config = parse_cfg_file(args.config) 
 
-    study_trax_df = pd.read_csv(args.studytrax_metadata, dtype='str')
-    broad_sample_df = pd.read_csv(args.broad_sample_tracking,
-                                  na_values=['destroyed', 'missed'],
-                                  parse_dates=['Actual Date of Receipt'])
+    study_trax_df = read_cached_csv(args.studytrax_metadata,
+                                    cache_dir=args.cache_dir, dtype='str')
+
+    ## The biopsy and blood sample ID columns are filtered against sample 
+    ## ID's over and over; as categoricals each isin only hashes the 
+    ## distinct ID's once.
+    for col in _STUDYTRAX_SAMPLE_ID_COLS:
+        study_trax_df[col] = study_trax_df[col].astype('category')
+    study_trax_stool_df = index_stool_visits(study_trax_df)
+
+    broad_sample_df = read_cached_csv(args.broad_sample_tracking,
+                                      cache_dir=args.cache_dir,
+                                      na_values=['destroyed', 'missed'],
+                                      parse_dates=['Actual Date of Receipt'])
+
     proteomics_df = None
     metadata_df = None
     new_metadata_df = None
@@ -989,7 +1056,7 @@ def main(args):
     ## Before we filter our metadata rows down to just to rows associated
     ## with the files we have present, we'll want a list of all the collection
     ## dates
-    collection_dates_dict = get_collection_dates(broad_sample_df)
+    collection_dates_df = get_collection_dates(broad_sample_df)
 
     biopsy_date_map = None
     if args.proteomics_metadata:
@@ -1011,7 +1078,7 @@ def main(args):
 
         if submitted_files:
             new_metadata = []
-            for (dtype, items) in submitted_files.iteritems():
+            for (dtype, items) in submitted_files.items():
                 input_files = items.get('input')
                 pair_identifier = items.get('pair_identifier')
 
@@ -1027,38 +1094,42 @@ def main(args):
                                                           proteomics_df,
                                                           dtype,
                                                           input_files,
-                                                          pair_identifier))
+                                                          pair_identifier,
+                                                          study_trax_stool_df))
  
             new_metadata_df = pd.concat(new_metadata, ignore_index=True)
 
             #new_metadata_df[new_metadata_df['External ID'].isnull()] = None
-            new_metadata_df['Site/Sub/Coll ID'] = new_metadata_df['Site/Sub/Coll'].map(lambda sid: str(sid))
+            new_metadata_df['Site/Sub/Coll ID'] = new_metadata_df['Site/Sub/Coll'].astype(str)
             #new_metadata_df['Participant ID'] = new_metadata_df['Subject'].map(lambda subj: 'C' + str(subj))
             if 'Collection #' in new_metadata_df.columns:
                 new_metadata_df['visit_num'] = new_metadata_df['Collection #']
-            new_metadata_df['Project'] = new_metadata_df.apply(get_project_id, axis=1)
+            new_metadata_df['Project'] = get_project_id(new_metadata_df)
             new_metadata_df['ProjectSpecificID'] = pd.to_numeric(new_metadata_df['ProjectSpecificID'])
             new_metadata_df['Site'] = new_metadata_df['SiteName']
-            new_metadata_df = new_metadata_df.apply(generate_external_id, axis=1)
+            new_metadata_df['External ID'] = generate_external_id(new_metadata_df)
 
             new_metadata_df = remove_columns(new_metadata_df, config.get('drop_cols'))
 
     if args.metadata_file:
-        metadata_df = pd.read_csv(args.metadata_file, parse_dates=['Actual Date of Receipt'])
+        ## Dates in an existing metadata file were written out by this script
+        ## so their format is known and doesn't need to be inferred.
+        metadata_df = read_csv(args.metadata_file)
+        metadata_df['Actual Date of Receipt'] = pd.to_datetime(metadata_df['Actual Date of Receipt'],
+                                                               format='%Y-%m-%d', cache=True)
     
         site_mapping = config.get('site_map')
-        metadata_df['Site/Sub/Coll ID'] = metadata_df.apply(fix_site_sub_coll_id,
-                                                            args=(site_mapping,),
-                                                            axis=1)
-        metadata_df['PDO Number'] = metadata_df.apply(get_pdo_number, axis=1)
+        metadata_df['Site/Sub/Coll ID'] = fix_site_sub_coll_id(metadata_df, site_mapping)
+        metadata_df['PDO Number'] = get_pdo_number(metadata_df)
 
-        if new_metadata_df and not new_metadata_df.empty:
+        if new_metadata_df is not None and not new_metadata_df.empty:
             metadata_df = pd.concat([metadata_df, new_metadata_df], ignore_index=True)
             metadata_df = metadata_df.drop_duplicates(subset=['External ID', 'Site/Sub/Coll ID', 'data_type'], keep='last')
     else:
         metadata_df = new_metadata_df
 
-    metadata_df[metadata_df['External ID'].isnull()] = metadata_df[metadata_df['External ID'].isnull()].apply(generate_external_id, axis=1)
+    missing_ids = metadata_df['External ID'].isnull()
+    metadata_df.loc[missing_ids, 'External ID'] = generate_external_id(metadata_df.loc[missing_ids])
 
     if args.auxillary_metadata:
         for aux_file in args.auxillary_metadata:
@@ -1079,23 +1150,29 @@ def main(args):
             new_cols = set(supp_columns[idx_offset:]) - set(metadata_cols)
             existing_cols = set(supp_columns[idx_offset:]).intersection(metadata_cols)
 
-            if new_cols:
-                supp_new_df = supp_df.filter(items=supp_columns[:idx_offset] + list(new_cols))
-                metadata_df = metadata_df.merge(supp_new_df, how='left', on=join_id)
+            ## Both stages share the same join index so it only needs to be 
+            ## built once per file.
+            if new_cols or existing_cols:
+                new_cols = [col for col in supp_columns[idx_offset:] if col in new_cols]
+                existing_cols = [col for col in supp_columns[idx_offset:] if col in existing_cols]
 
-            if existing_cols:
-                supp_existing_df = supp_df.filter(items=supp_columns[:idx_offset] + list(existing_cols))
                 metadata_df.set_index(join_id, inplace=True)
-                supp_existing_df.set_index(join_id, inplace=True)
+                supp_df.set_index(join_id, inplace=True)
 
-                metadata_df.update(supp_existing_df)
-                metadata_df.reset_index(inplace=True)
+                if new_cols:
+                    metadata_df = metadata_df.join(supp_df[new_cols], how='left')
+                if existing_cols:
+                    metadata_df.update(supp_df[existing_cols])
+
+                metadata_df = metadata_df.reset_index()[metadata_cols + new_cols]
 
     if args.add_all_stool_collections:
         metadata_df = add_all_stool_collections(metadata_df, study_trax_df, broad_sample_df)
 
-    metadata_df['Actual Date of Receipt'] = pd.to_datetime(metadata_df['Actual Date of Receipt'])
-    metadata_df['visit_num'] = metadata_df.apply(fill_visit_nums, axis=1)
+    if not pd.api.types.is_datetime64_any_dtype(metadata_df['Actual Date of Receipt']):
+        metadata_df['Actual Date of Receipt'] = pd.to_datetime(metadata_df['Actual Date of Receipt'],
+                                                               cache=True)
+    metadata_df['visit_num'] = fill_visit_nums(metadata_df)
 
     metadata_df['hbi_score'] = pd.to_numeric(metadata_df['hbi_score'])
     if 'Site' in metadata_df.columns.tolist():
@@ -1104,20 +1181,44 @@ def main(args):
         metadata_df['Site'] = metadata_df['SiteName']
 
     ## Couple small remaining changes
-    metadata_df.ix[metadata_df.hbi_score > 900, 'hbi_score'] = None 
-    metadata_df.ix[metadata_df.consent_age > 150, 'consent_age'] = None 
-    metadata_df['total_reads'].loc[metadata_df['total_reads'].astype('str').str.startswith('PDO')] = None 
+    metadata_df['hbi_score'] = np.where(metadata_df['hbi_score'] > 900, np.nan, 
+                                        metadata_df['hbi_score'])
+    metadata_df['consent_age'] = np.where(metadata_df['consent_age'] > 150, np.nan, 
+                                          metadata_df['consent_age'])
+
+    ## PDO numbers only ever sneak into total_reads as strings so a purely
+    ## numeric column has nothing to clean up.
+    if metadata_df['total_reads'].dtype == object:
+        metadata_df.loc[metadata_df['total_reads'].str.startswith('PDO', na=False), 
+                        'total_reads'] = None
     metadata_df['Research Project'] = "ibdmdb"
 
-    metadata_df = generate_collection_statistics(metadata_df, collection_dates_dict, biopsy_date_map)
+    ## These repeat the same handful of values across every row and are 
+    ## only ever compared against. Site and SiteName are left alone as they 
+    ## still get filled in below.
+    for col in _CATEGORICAL_COLS:
+        if col in metadata_df.columns:
+            metadata_df[col] = metadata_df[col].astype('category')
+
+    metadata_df = generate_collection_statistics(metadata_df, collection_dates_df, biopsy_date_map)
     metadata_df = add_baseline_metadata_values(metadata_df, study_trax_df, config.get('baseline_cols'))
 
-    metadata_df[metadata_df['SiteName'].isnull()] = fix_site_name(metadata_df[metadata_df['SiteName'].isnull()])
+    missing_sites = metadata_df['SiteName'].isnull()
+    metadata_df.loc[missing_sites, ['SiteName', 'Site']] = (fix_site_name(metadata_df.loc[missing_sites])
+                                                            [['SiteName', 'Site']])
     metadata_df = reorder_columns(metadata_df, config.get('col_order'))
-    metadata_df.drop(['Site'], 1, inplace=True)
-
-    metadata_df = metadata_df.sort_values(['data_type', 'Participant ID', 'visit_num'])
-    metadata_df.to_csv(metadata_file, index=False)
+    metadata_df.drop(['Site'], axis=1, inplace=True)
+
+    ## Sorting on categorical codes and a numeric copy of the visit number
+    ## avoids comparing mixed str/int visit numbers row by row.
+    metadata_df['Participant ID'] = metadata_df['Participant ID'].astype('category')
+    metadata_df = (metadata_df.assign(visit_sort=pd.to_numeric(metadata_df['visit_num'], 
+                                                               errors='coerce'))
+                              .sort_values(['data_type', 'Participant ID', 'visit_sort'],
+                                           kind='mergesort')
+                              .drop('visit_sort', axis=1))
+    metadata_df.to_csv(metadata_file, index=False, chunksize=100000, 
+                       date_format='%Y-%m-%d')
 
 
 if __name__ == "__main__":
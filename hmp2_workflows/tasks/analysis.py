@@ -95,7 +95,7 @@ def generate_relative_abundance_file(workflow, counts_table, output_dir):
         """
         counts_df = pd.read_table(counts_table, index_col=0)
         abund_df = counts_df / counts_df.sum()
-        abund_df.write_csv(abundance_table, sep='\t', index=True)
+        abund_df.to_csv(abundance_table, sep='\t', index=True)
 
     workflow.add_task(_compute_relative_abundances,
                       depends=counts_table,
@@ -28,29 +28,498 @@ furnished to do so, subject to the following conditions:
     THE SOFTWARE.
 """
 
+import collections
+import hashlib
+import heapq
 import itertools
 import os
 import shutil
+import subprocess
 import tempfile
 
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
 from biobakery_workflows import utilities as bb_utils
 from hmp2_workflows import utils as hmp_utils
 
 
-def verify_files(workflow, input_files, checksums_file):
+## Number of files checked by each md5sum verification task
+VERIFY_BATCH_SIZE = 64
+
+## Maximum number of files copied (or symlinked) by each staging task
+STAGE_BATCH_SIZE = 128
+
+## Maximum number of bytes copied by each staging task; files larger than 
+## STAGE_LARGE_FILE_BYTES are always copied by a task of their own so that 
+## they can be transferred in parallel
+STAGE_BATCH_BYTES = 4 * 1024**3
+STAGE_LARGE_FILE_BYTES = 1024**3
+
+## Commands used to compress tarballs keyed on the compressor's name. 
+## Both pigz and gzip produce gzip-compatible output.
+TAR_COMPRESSORS = {'gzip': 'gzip', 
+                   'pigz': 'pigz -p %(threads)s', 
+                   'zstd': 'zstd -T%(threads)s -19'}
+
+## Tarball extensions accepted for zstd output; gzip-compatible output is 
+## written to whatever name it is given as it always has been.
+ZSTD_TAR_EXTENSIONS = ('.tar.zst', '.tzst')
+
+## Checksum tools that can be used for integrity checks keyed on the 
+## extension of the checksum files they produce. All of these share the 
+## md5sum output and check formats.
+CHECKSUM_TOOLS = {'.md5': 'md5sum', '.xxh128': 'xxh128sum', '.b3': 'b3sum'}
+
+## The checksum tool and extension used for checksums we generate. MD5 is 
+## kept as the default as checksums are handed off to external consumers.
+INTEGRITY_HASH = ('md5sum', '.md5')
+
+## Size of the chunks hashed independently when generating parallel md5 
+## checksums. The resulting checksum depends on this value so it must not 
+## change between generating and verifying checksums.
+PARALLEL_MD5_BLOCK_SIZE = '512M'
+
+## Parsed checksum files keyed on their path; each entry also holds the 
+## modification time (in nanoseconds) and size of the file when it was parsed
+_CHECKSUMS_CACHE = {}
+
+## The location, size and modification time (in nanoseconds) of a file as 
+## gathered by _scan
+_PathInfo = collections.namedtuple('_PathInfo', ['path', 'dirname', 'basename',
+                                                 'size', 'mtime_ns'])
+
+## Extended attribute used to cache a file's md5 checksum alongside the 
+## size and modification time it was computed for
+MD5_XATTR = 'user.md5sum'
+
+
+def cached_parse_checksums_file(checksums_file):
+    """Parses the provided checksums file re-using the results of any 
+    previous parse of the file if it hasn't changed since.
+
+    Args:
+        checksums_file (string): Path to file containing checksums.
+
+    Requires:
+        None
+
+    Returns:
+        dict: A dictionary of file names to checksums.
+    """
+    file_stat = os.stat(checksums_file)
+    file_stamp = (file_stat.st_mtime_ns, file_stat.st_size)
+    cache_key = os.path.abspath(checksums_file)
+
+    (cached_stamp, checksums_dict) = _CHECKSUMS_CACHE.get(cache_key, (None, None))
+    if cached_stamp != file_stamp:
+        checksums_dict = hmp_utils.misc.parse_checksums_file(checksums_file)
+        _CHECKSUMS_CACHE[cache_key] = (file_stamp, checksums_dict)
+
+    return checksums_dict
+
+
+def clear_checksums_cache():
+    """Empties the cache of parsed checksum files.
+
+    Args:
+        None
+
+    Requires:
+        None
+
+    Returns:
+        None
+    """
+    _CHECKSUMS_CACHE.clear()
+
+
+def _parallel_md5_cmd(input_file, threads):
+    """Returns the shell command used to compute a "parallel" md5 checksum 
+    for the provided file; the md5 checksum of the concatenated md5 
+    checksums of each PARALLEL_MD5_BLOCK_SIZE chunk of the file.
+
+    Chunks are hashed concurrently with GNU parallel when it is installed and
+    sequentially with GNU split otherwise. Both produce the same checksum.
+
+    Args:
+        input_file (string): The file (or AnADAMA2 depends placeholder) to 
+            checksum.
+        threads (int or string): The number of chunks to hash concurrently.
+
+    Requires:
+        GNU parallel (optional)
+
+    Returns:
+        string: A shell command that prints the parallel md5 checksum.
+    """
+    return ("if command -v parallel > /dev/null 2>&1; then "
+            "parallel --pipepart --recend '' --block %(block)s -a %(file)s "
+            "-k -j %(threads)s md5sum; "
+            "else split -b %(block)s --filter md5sum %(file)s; fi | "
+            "md5sum | awk '{print $1}'" % {'block': PARALLEL_MD5_BLOCK_SIZE,
+                                          'file': input_file,
+                                          'threads': threads})
+
+
+def get_cached_md5(file_path):
+    """Returns the md5 checksum cached in the extended attributes of the 
+    provided file if the file has not changed since the checksum was cached.
+
+    Args:
+        file_path (string): Path to the file to retrieve a checksum for.
+
+    Requires:
+        None
+
+    Returns:
+        string: The cached md5 checksum or None if no valid checksum is 
+            cached (or extended attributes are not supported).
+    """
+    try:
+        cached_value = os.getxattr(file_path, MD5_XATTR).decode('ascii')
+        (size, mtime, md5sum) = cached_value.split(':')
+        file_stat = os.stat(file_path)
+    except (AttributeError, OSError, ValueError):
+        return None
+
+    if (int(size), int(mtime)) != (file_stat.st_size, file_stat.st_mtime_ns):
+        return None
+
+    return md5sum
+
+
+def cached_md5(file_path, block_size=1 << 20):
+    """Returns the md5 checksum of the provided file, re-using the checksum 
+    cached in the files extended attributes when the file is unchanged. On a
+    cache miss the checksum is computed and written back to the file.
+
+    Args:
+        file_path (string): Path to the file to checksum.
+        block_size (int): Number of bytes read at a time when hashing.
+
+    Requires:
+        None
+
+    Returns:
+        string: The md5 checksum of the file.
+    """
+    md5sum = get_cached_md5(file_path)
+    if md5sum:
+        return md5sum
+
+    file_stat = os.stat(file_path)
+    md5 = hashlib.md5()
+    with open(file_path, 'rb') as file_handle:
+        for block in iter(lambda: file_handle.read(block_size), b''):
+            md5.update(block)
+    md5sum = md5.hexdigest()
+
+    ## Caching is best-effort; filesystems without user xattr support (or 
+    ## files we can't write to) just get re-hashed next time.
+    try:
+        os.setxattr(file_path, MD5_XATTR, 
+                    ("%d:%d:%s" % (file_stat.st_size, file_stat.st_mtime_ns,
+                                   md5sum)).encode('ascii'))
+    except (AttributeError, OSError):
+        pass
+
+    return md5sum
+
+
+def _batch_files(files, batch_size):
+    """Splits a list of files into batches of at most batch_size files with
+    each batch only containing files from the same directory.
+
+    Args:
+        files (list): A list of files to batch.
+        batch_size (int): The maximum number of files in each batch.
+
+    Requires:
+        None
+
+    Returns:
+        generator: Yields lists of files.
+    """
+    sorted_files = sorted(files, key=os.path.dirname)
+    for (_dir, dir_files) in itertools.groupby(sorted_files, os.path.dirname):
+        dir_files = iter(dir_files)
+        batch = list(itertools.islice(dir_files, batch_size))
+
+        while batch:
+            yield batch
+            batch = list(itertools.islice(dir_files, batch_size))
+
+
+def _scan(paths):
+    """Gathers the size and modification time of each of the provided paths.
+    Paths that do not exist have a size and modification time of None.
+
+    Args:
+        paths (list): A list of file paths.
+
+    Requires:
+        None
+
+    Returns:
+        list: A list of _PathInfo tuples in the same order as the paths.
+    """
+    path_infos = []
+
+    for path in paths:
+        try:
+            file_stat = os.stat(path)
+            (size, mtime_ns) = (file_stat.st_size, file_stat.st_mtime_ns)
+        except OSError:
+            (size, mtime_ns) = (None, None)
+
+        path_infos.append(_PathInfo(path, os.path.dirname(path), 
+                                    os.path.basename(path), size, mtime_ns))
+
+    return path_infos
+
+
+class PathSet(object):
+    """A collection of file paths along with their sizes, modification times,
+    directories and basenames (gathered once via _scan). A PathSet can be 
+    passed to any of the functions in this module in place of a list of 
+    files so the same paths aren't re-stat'd at each step.
+
+    Args:
+        paths (list): A list of file paths.
+
+    Example:
+        from hmp2_workflows.tasks import common
+
+        input_files = common.PathSet(['/tmp/fooA.bam', '/tmp/fooB.bam'])
+        common.verify_files(workflow, input_files, '/tmp/foo_checksums.txt')
+        common.stage_files(workflow, input_files, '/tmp/out_dir')
+    """
+
+    def __init__(self, paths):
+        self.infos = _scan(list(paths))
+        self.paths = [path_info.path for path_info in self.infos]
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, idx):
+        return self.paths[idx]
+
+
+def _as_paths(files):
+    """Returns the list of file paths held by the provided PathSet or the 
+    provided files as-is if they are not a PathSet.
+
+    Args:
+        files (PathSet or list): The files to convert.
+
+    Requires:
+        None
+
+    Returns:
+        list: A list of file paths.
+    """
+    return files.paths if isinstance(files, PathSet) else files
+
+
+def _size_batch_files(file_infos, batch_bytes, batch_count):
+    """Splits a list of files into batches of files from the same directory
+    holding at most batch_bytes bytes or batch_count files, whichever limit 
+    is reached first. Files larger than STAGE_LARGE_FILE_BYTES are placed in
+    a batch of their own.
+
+    Args:
+        file_infos (list): A list of _PathInfo tuples for the files to batch.
+        batch_bytes (int): The maximum number of bytes in each batch.
+        batch_count (int): The maximum number of files in each batch.
+
+    Requires:
+        None
+
+    Returns:
+        generator: Yields lists of files.
+    """
+    sorted_infos = sorted(file_infos, key=lambda file_info: file_info.dirname)
+    for (_dir, dir_infos) in itertools.groupby(sorted_infos, 
+                                               lambda file_info: file_info.dirname):
+        (batch, batch_size) = ([], 0)
+
+        for dir_info in dir_infos:
+            file_size = dir_info.size or 0
+            if file_size > STAGE_LARGE_FILE_BYTES:
+                yield [dir_info.path]
+                continue
+
+            if batch and (batch_size + file_size > batch_bytes or 
+                          len(batch) == batch_count):
+                yield batch
+                (batch, batch_size) = ([], 0)
+
+            batch.append(dir_info.path)
+            batch_size += file_size
+
+        if batch:
+            yield batch
+
+
+def _shard_files(file_infos, num_shards):
+    """Splits a list of files into at most num_shards shards per directory 
+    with each shard holding roughly the same number of bytes. Files are 
+    assigned largest first to the currently smallest shard.
+
+    Args:
+        file_infos (list): A list of _PathInfo tuples for the files to shard.
+        num_shards (int): The number of shards to split each directory's 
+            files into.
+
+    Requires:
+        None
+
+    Returns:
+        generator: Yields lists of files.
+    """
+    sorted_infos = sorted(file_infos, key=lambda file_info: file_info.dirname)
+    for (_dir, dir_infos) in itertools.groupby(sorted_infos, 
+                                               lambda file_info: file_info.dirname):
+        sized_files = sorted(((dir_info.size or 0, dir_info.path) 
+                              for dir_info in dir_infos), reverse=True)
+
+        shards = [(0, idx, []) for idx in range(min(num_shards, len(sized_files)))]
+        for (file_size, dir_file) in sized_files:
+            (shard_size, idx, shard_files) = heapq.heappop(shards)
+            shard_files.append(dir_file)
+            heapq.heappush(shards, (shard_size + file_size, idx, shard_files))
+
+        for (_size, _idx, shard_files) in sorted(shards, key=lambda shard: shard[1]):
+            yield shard_files
+
+
+def verified_sentinel(input_file, sentinel_dir):
+    """Returns the path of the sentinel file touched by verify_files once the
+    provided file has passed verification.
+
+    Args:
+        input_file (string): Path to the verified file.
+        sentinel_dir (string): Directory holding the sentinel files.
+
+    Requires:
+        None
+
+    Returns:
+        string: Path to the sentinel file.
+    """
+    return os.path.join(sentinel_dir, "%s.verified" % os.path.basename(input_file))
+
+
+def _file_stamps(files):
+    """Gathers the size and modification time (in nanoseconds) of each of 
+    the provided files. Files that do not exist have a stamp of None.
+
+    Args:
+        files (list): A list of file paths.
+
+    Requires:
+        None
+
+    Returns:
+        dict: A dictionary of absolute file paths to (size, mtime_ns) 
+            tuples.
+    """
+    file_stamps = {}
+    for file_path in files:
+        try:
+            file_stat = os.stat(file_path)
+            file_stamps[os.path.abspath(file_path)] = (file_stat.st_size, 
+                                                       file_stat.st_mtime_ns)
+        except OSError:
+            file_stamps[os.path.abspath(file_path)] = None
+
+    return file_stamps
+
+
+def _read_file_stamps(stamps_file):
+    """Parses the file stamps recorded in a verification sentinel written by
+    verify_files. Sentinels that can't be read (or pre-date file stamps) 
+    have no stamps.
+
+    Args:
+        stamps_file (string): Path to the sentinel file.
+
+    Requires:
+        None
+
+    Returns:
+        dict: A dictionary of absolute file paths to (size, mtime_ns) 
+            tuples.
+    """
+    file_stamps = {}
+    try:
+        with open(stamps_file) as stamps_fh:
+            for line in stamps_fh:
+                (file_path, size, mtime_ns) = line.rstrip('\n').rsplit('\t', 2)
+                file_stamps[file_path] = (int(size), int(mtime_ns))
+    except (IOError, OSError, ValueError):
+        return {}
+
+    return file_stamps
+
+
+def _workflow_targets(workflow):
+    """Returns the absolute paths of all targets of the tasks added to the 
+    provided workflow so far.
+
+    Args:
+        workflow (anadama2.Workflow): The workflow object.
+
+    Requires:
+        None
+
+    Returns:
+        set: The absolute path of each task target.
+    """
+    return set(os.path.abspath(getattr(target, 'name', target)) 
+               for task in getattr(workflow, 'tasks', []) 
+               for target in task.targets)
+
+
+def verify_files(workflow, input_files, checksums_file, parallel_md5=False,
+                 threads=1, sentinel_dir=None, force=False):
     """Verifies the integrity of all files found under the supplied directory 
     using md5 checksums. In order for this function to work properly an file 
     contanining md5 checksums must have been generated on the source side of 
     the files and provided when these files were uploaded.
 
     Args:
-        input_file_dir (string): Path to directory containing files to be 
-           checked.
+        input_files (list or PathSet): The files to be checked.
         checksums_file (string): Path to file containing the source side md5 
             checksums.
+        parallel_md5 (boolean): If set to True the provided checksums were 
+            generated with generate_md5_checksums(parallel_md5=True) and are
+            verified the same way.
+        threads (int): Number of threads used by each parallel md5 task.
+        sentinel_dir (string): If provided a sentinel file (see 
+            verified_sentinel) is touched in this directory for each file 
+            that passes verification. Passing the same directory to 
+            stage_files, tar_files and generate_md5_checksums has them wait 
+            only on the verification of the files they consume.
+        force (boolean): By default verification is skipped if every file
+            passed verification against this checksums file on a previous 
+            run and none of them (nor the checksums file) have changed size 
+            or modification time since. If set to True verify all files 
+            regardless.
+
+    The checksum tool used is selected by the extension of the checksums 
+    file (see CHECKSUM_TOOLS) defaulting to md5sum for externally provided
+    checksum files.
 
     Requires:
-        None
+        GNU parallel (optional)
 
     Returns:
         list: A list of files that have passed integrity verification
@@ -65,20 +534,131 @@ def verify_files(workflow, input_files, checksums_file):
                                    ['/tmp/fooA.bam', '/tmp/fooB.bam'],
                                    '/tmp/foo_checksums.txt)
     """
-    checksums_dict = hmp_utils.misc.parse_checksums_file(checksums_file)
-
-    for input_file in input_files:
-        md5sum = checksums_dict.get(os.path.basename(input_file))
-        
-        if not md5sum:
-            raise KeyError('MD5 checksum not found.', input_file)
-
-        workflow.add_task_gridable('echo "[args[0]] *[depends[0]]" | md5sum -c -',
-                                   depends = [input_file],
-                                   args = [md5sum],
-                                   time = 24*60,
-                                   mem = 1024,
-                                   cores = 1)
+    input_infos = (input_files.infos if isinstance(input_files, PathSet) 
+                   else None)
+    input_files = _as_paths(input_files)
+
+    ## A "<checksums file>.verified" sentinel records the size and 
+    ## modification time of the checksums file and every input file once 
+    ## they have all been verified. If none of them have changed since, 
+    ## everything was verified on a previous run. Inputs produced by other 
+    ## tasks in this workflow may still be rewritten when it runs so these 
+    ## are always verified.
+    checksums_sentinel = "%s.verified" % checksums_file
+    stamped_files = [checksums_file] + list(input_files)
+    workflow_targets = _workflow_targets(workflow)
+    if not force and os.path.exists(checksums_sentinel):
+        file_stamps = _file_stamps(stamped_files)
+        per_file_sentinels = (not sentinel_dir or 
+                              all(os.path.exists(verified_sentinel(input_file, sentinel_dir))
+                                  for input_file in input_files))
+
+        if (None not in file_stamps.values() and per_file_sentinels and
+                _read_file_stamps(checksums_sentinel) == file_stamps and
+                workflow_targets.isdisjoint(file_stamps)):
+            return input_files
+
+    checksums_dict = cached_parse_checksums_file(checksums_file)
+
+    ## Look up every file's expected checksum once and fail before adding 
+    ## any tasks if any of them are missing.
+    basenames = ([input_info.basename for input_info in input_infos] if input_infos
+                 else [os.path.basename(input_file) for input_file in input_files])
+    missing_files = set(basenames).difference(checksums_dict)
+    if missing_files:
+        raise KeyError('MD5 checksum not found.', sorted(missing_files))
+
+    expected_checksums = dict(zip(input_files, 
+                                  (checksums_dict[basename] for basename in basenames)))
+
+    sentinel_files = {}
+    if sentinel_dir:
+        if not os.path.exists(sentinel_dir):
+            os.makedirs(sentinel_dir)
+
+        sentinel_files = {input_file: verified_sentinel(input_file, sentinel_dir)
+                          for input_file in input_files}
+
+    def _touch_sentinels_cmd(files):
+        return "touch %s" % " ".join(quote(sentinel_files[verified_file])
+                                     for verified_file in files)
+
+    def _on_success_cmd(files):
+        return " && " + _touch_sentinels_cmd(files) if sentinel_dir else ""
+
+    verify_tasks = []
+    if parallel_md5:
+        ## Parallel checksums can't be checked by md5sum or cached so each
+        ## file gets its own task comparing against the expected checksum.
+        for input_file in input_files:
+            verify_cmd = 'test "$(%s)" = %s%s' % (_parallel_md5_cmd('[depends[0]]', threads),
+                                                  quote(expected_checksums[input_file]),
+                                                  _on_success_cmd([input_file]))
+
+            verify_task = workflow.add_task_gridable(verify_cmd,
+                                                     depends = [input_file],
+                                                     targets = [sentinel_files[input_file]] if sentinel_dir else [],
+                                                     time = 24*60,
+                                                     mem = 1024,
+                                                     cores = threads)
+            verify_tasks.append(verify_task)
+    else:
+        checksum_tool = CHECKSUM_TOOLS.get(os.path.splitext(checksums_file)[1],
+                                           'md5sum')
+
+        ## Files whose cached checksum already matches the expected checksum 
+        ## were verified on a previous run and haven't changed since. Only md5
+        ## checksums are cached and checked by our caching md5 checker. Files
+        ## produced by other tasks in this workflow may be rewritten before 
+        ## this one runs so their cached checksums can't be trusted.
+        if checksum_tool == 'md5sum':
+            checksum_tool = 'hmp_cached_md5.py'
+            unverified_files = [input_file for input_file in input_files
+                                if os.path.abspath(input_file) in workflow_targets or
+                                   get_cached_md5(input_file) != 
+                                   expected_checksums[input_file]]
+        else:
+            unverified_files = input_files
+
+        ## Files verified on a previous run still need their sentinels
+        if sentinel_dir:
+            cached_files = set(input_files).difference(unverified_files)
+            for batch_files in _batch_files(cached_files, VERIFY_BATCH_SIZE):
+                workflow.add_task(_touch_sentinels_cmd(batch_files),
+                                  depends = batch_files,
+                                  targets = [sentinel_files[verified_file] for 
+                                             verified_file in batch_files])
+
+        ## Rather than submitting a grid job per file we check a batch of files
+        ## in each job by feeding the expected checksums for the batch to the 
+        ## checksum tool.
+        for batch_files in _batch_files(unverified_files, VERIFY_BATCH_SIZE):
+            checksum_lines = [quote("%s  %s" % (expected_checksums[input_file], input_file))
+                              for input_file in batch_files]
+
+            verify_cmd = "printf '%%s\\n' %s | %s -c -%s" % (" ".join(checksum_lines),
+                                                              checksum_tool,
+                                                              _on_success_cmd(batch_files))
+
+            verify_task = workflow.add_task_gridable(verify_cmd,
+                                                     depends = batch_files,
+                                                     targets = [sentinel_files[input_file] for 
+                                                                input_file in batch_files] if sentinel_dir else [],
+                                                     time = 24*60,
+                                                     mem = 1024,
+                                                     cores = 1)
+            verify_tasks.append(verify_task)
+
+    ## Mark the checksums file as verified once every file has passed so 
+    ## that re-runs can skip verification altogether.
+    def _write_file_stamps(task):
+        with open(task.targets[0].name, 'w') as sentinel_fh:
+            for (file_path, file_stamp) in sorted(_file_stamps(stamped_files).items()):
+                sentinel_fh.write("%s\t%d\t%d\n" % ((file_path,) + file_stamp))
+
+    workflow.add_task(_write_file_stamps,
+                      depends = verify_tasks + stamped_files,
+                      targets = [checksums_sentinel])
 
     ## Kind of wonky but if the workflow doesn't fail than the files we 
     ## passed in should all be valid. Right?
@@ -86,7 +666,10 @@ def verify_files(workflow, input_files, checksums_file):
 
 
 def stage_files(workflow, input_files, target_dir, delete=False, 
-                preserve=False, symlink=False):
+                preserve=False, symlink=False, parallel=None, force=False,
+                sentinel_dir=None, reflink=False, 
+                transfer_batch_bytes=STAGE_BATCH_BYTES, 
+                transfer_batch_count=STAGE_BATCH_SIZE):
     """Moves data files from the supplied origin directory to the supplied
     destination directory. In order to include a file verification check in
     the staging process rsync is used by default to copy files.
@@ -99,7 +682,8 @@ def stage_files(workflow, input_files, target_dir, delete=False,
 
     Args:
         workflow (anadama2.Workflow): The workflow object.
-        input_files: A collection of input files to be staged.
+        input_files (list or PathSet): A collection of input files to be 
+            staged.
         dest_dir (string): Path to destination directory where files should 
             be moved.
         preserve (boolean): If set to True preserve the source subdirectory 
@@ -107,6 +691,26 @@ def stage_files(workflow, input_files, target_dir, delete=False,
         symlink (boolean): By default create symlinks from the origin 
             directory to the destination directory. If set to 
             False files will be copied using rsync.
+        reflink (boolean): If set to True copy files with 
+            cp --reflink=auto which clones files without copying any data 
+            when the source and target share a copy-on-write filesystem 
+            (XFS, Btrfs) and does a regular copy otherwise. Falls back to 
+            rsync if cp fails.
+        parallel (int): If provided split each source directory's files 
+            into this many byte-balanced shards, each copied by its own 
+            rsync task so that several rsync streams can run at once. More 
+            workers than the source disks can serve just causes seek 
+            contention so this should stay small (4-8).
+        transfer_batch_bytes (int): When not staging in parallel, the 
+            maximum number of bytes copied by each staging task.
+        transfer_batch_count (int): The maximum number of files staged by 
+            each staging task.
+        force (boolean): By default rsync (or cp) skips files that are 
+            already staged (same size and modification time as the source). 
+            If set to True copy all files regardless.
+        sentinel_dir (string): The sentinel directory passed to 
+            verify_files; each staging task then waits on the verification 
+            of the files it stages.
 
     Requires:
         rsync v3.0.6+: A versatile file copying tool.
@@ -129,24 +733,66 @@ def stage_files(workflow, input_files, target_dir, delete=False,
     if not os.path.exists(target_dir):
         raise OSError(2, 'Target directory does not exist', target_dir)
 
+    source_infos = (input_files.infos if isinstance(input_files, PathSet) 
+                    else None)
+    input_files = _as_paths(input_files)
+
     ## TODO: We need to preserve the file directory structure here because
     ## it tells when the files were received and is used by the website.
     target_files = bb_utils.name_files(input_files, target_dir)
 
-    ## TODO: Figure out a better way to handle this rather than creating 
-    ## N rsync calls.
-    stage_cmd = "remove_if_exists.py [targets[0]] ; rsync -avz [depends[0]] [targets[0]]"
-    
-    if preserve:
-        stage_cmd = stage_cmd.replace('-avz', 
-                                      '--rsync-path=\"mkdir -p `dirname '
-                                      '[depends[0]]`\" -avz')
-    if symlink:
-        stage_cmd = "remove_if_exists.py [targets[0]] ; ln -s [depends[0]] [targets[0]]"
+    if source_infos is None:
+        source_infos = _scan(input_files)
 
-    workflow.add_task_group(stage_cmd,
-                            depends = input_files,
-                            targets = target_files)
+    ## Re-runs (e.g. after a partial failure) don't need to copy files that 
+    ## made it over the first time around. Whether a file is up to date is 
+    ## only known once the task runs so this is left to rsync's quick check
+    ## (and cp --update) rather than decided here.
+    rsync_opts = '-avz' if not force else '-avz --ignore-times'
+    cp_opts = '-upf' if not force else '-pf'
+
+    ## Rather than an rsync (or ln) call per file we stage each directory's 
+    ## files in batches, feeding rsync the batch's file names on stdin.
+    ## Small files are batched together to amortize rsync's overhead while 
+    ## large files get tasks of their own so they are copied in parallel.
+    if symlink:
+        file_batches = _batch_files(input_files, transfer_batch_count)
+    elif parallel:
+        file_batches = _shard_files(source_infos, parallel)
+    else:
+        file_batches = _size_batch_files(source_infos, transfer_batch_bytes,
+                                         transfer_batch_count)
+
+    for batch_files in file_batches:
+        source_dir = os.path.dirname(batch_files[0]) or '.'
+        file_names = [quote(os.path.basename(input_file)) for input_file
+                      in batch_files]
+
+        stage_cmd = ("printf '%%s\\n' %s | rsync %s --files-from=- %s/ %s/" % 
+                     (" ".join(file_names), rsync_opts, quote(source_dir), 
+                      quote(target_dir)))
+
+        if preserve:
+            stage_cmd = stage_cmd.replace('-avz', 
+                                          '--rsync-path=\"mkdir -p `dirname '
+                                          '[depends[0]]`\" -avz')
+        if symlink:
+            stage_cmd = "ln -sf %s %s/" % (" ".join(map(quote, batch_files)),
+                                           quote(target_dir))
+        elif reflink:
+            stage_cmd = "cp --reflink=auto %s %s %s/ || %s" % (cp_opts,
+                                                                " ".join(map(quote, batch_files)),
+                                                                quote(target_dir),
+                                                                stage_cmd)
+
+        depend_files = list(batch_files)
+        if sentinel_dir:
+            depend_files.extend(verified_sentinel(input_file, sentinel_dir) 
+                                for input_file in batch_files)
+
+        workflow.add_task(stage_cmd,
+                          depends = depend_files,
+                          targets = bb_utils.name_files(batch_files, target_dir))
 
     return target_files
 
@@ -180,35 +826,50 @@ def make_files_web_visible(workflow, files):
     ## Making a group of files web visible is as simple as touching a file 
     ## named complete.html in the directories containing the files we want 
     ## to show up on the website
+    if isinstance(files, PathSet):
+        files = [files]
+
     public_files = itertools.chain.from_iterable(files)
-    public_dirs = itertools.groupby(public_files, os.path.dirname)
-    complete_files = [os.path.join(item[0], 'complete.html') for item
-                      in public_dirs]
+    complete_files = sorted({os.path.join(os.path.dirname(public_file),
+                                          'complete.html')
+                             for public_file in public_files})
 
-    workflow.add_task_group('touch [targets[0]]',
-                            depends = map(os.path.dirname, complete_files),
-                            targets = complete_files)
+    ## A single touch covers every directory rather than a task per file
+    if complete_files:
+        workflow.add_task('touch %s' % " ".join(map(quote, complete_files)),
+                          depends = [os.path.dirname(complete_file) for
+                                     complete_file in complete_files],
+                          targets = complete_files)
 
     ## Again kinda lazy, but the files passed in will be the ones that are
     ## made public.
     return files
 
 
-def tar_files(workflow, files, output_tarball, depends, compress=True):
+def tar_files(workflow, files, output_tarball, depends, compress=True,
+              compressor='pigz', threads=4, sentinel_dir=None):
     """Creates a tarball package of the provided files with the given output
     tarball file path.
 
     Args:
         workflow (anadama2.Workflow): The workflow object.
-        files (list): A list of files to package together into a tarball.
+        files (list or PathSet): A list of files to package together into a 
+            tarball.
         output_tarball (string): The desired output tarball file.
         depends (list): A list of files that can be tied to the files to 
             be tar'd. These dependencies are not tar'd but needed to make 
             sure that this step in the workflow is not run out of order.
-        compress (string):             
+        compress (boolean): If set to True compress the tarball.
+        compressor (string): The compressor to use, one of TAR_COMPRESSORS.
+            zstd tarballs must be named with one of ZSTD_TAR_EXTENSIONS. 
+            pigz falls back to gzip if it is not installed.
+        threads (int): Number of threads used by the compressor.
+        sentinel_dir (string): The sentinel directory passed to 
+            verify_files; the tarball then waits on the verification of
+            only the files being tar'd.
 
     Requires:
-        None
+        pigz (optional) or zstd
 
     Returns:
         string: Path to the newly created tarball file.
@@ -224,45 +885,90 @@ def tar_files(workflow, files, output_tarball, depends, compress=True):
 
         out_tar = common.tar_files(workflow, files_to_tar, tar_file)
     """
-    ## Though there may be a cleaner way of doing this we need to create 
-    ## a temporary folder to symlink all the files we want to package into 
-    ## a tarball to get rid of tar'ing the directory structure as well.
-    tmp_dir = tempfile.mkdtemp()
-    tar_args = "-hcvf"
-
-    for target_file in files:
-        symlink_path = os.path.join(tmp_dir, os.path.basename(target_file))
-        os.symlink(target_file, symlink_path)
-    
+    ## Rather than symlinking everything into a temporary folder we have tar
+    ## strip the directory structure from each file as it is archived. The 
+    ## files to tar are handed over in a temporary list file, written when 
+    ## the task runs, to keep the command line short.
+    files = _as_paths(files)
+
     depend_files = []
     if depends:
         depend_files.extend(depends)
     else:
         depend_files.extend(files)
 
+    if sentinel_dir:
+        depend_files.extend(verified_sentinel(target_file, sentinel_dir) 
+                            for target_file in files)
+
+    tar_args = "-hcf"
     if compress:
-        tar_args = tar_args + "z"
-    
-    workflow.add_task('tar -hcvzf [targets[0]] -C [args[0]] .; rm -rf [args[0]]',
+        if compressor not in TAR_COMPRESSORS:
+            raise ValueError('Unknown tarball compressor', compressor)
+        if compressor == 'zstd' and not output_tarball.endswith(ZSTD_TAR_EXTENSIONS):
+            raise ValueError('zstd tarballs must end in one of %s' % 
+                             ", ".join(ZSTD_TAR_EXTENSIONS), output_tarball)
+
+        ## Only gzip-compatible compressors can fall back to gzip; zstd 
+        ## tarballs would otherwise end up holding gzip data.
+        compress_cmd = TAR_COMPRESSORS[compressor] % {'threads': threads}
+        if compressor != 'zstd':
+            compress_cmd = ("$(command -v %s > /dev/null 2>&1 && echo '%s' || "
+                            "echo gzip)" % (compress_cmd.split()[0], compress_cmd))
+        tar_args = "--use-compress-program=\"%s\" %s" % (compress_cmd, tar_args)
+
+    def _tar_files(task):
+        with tempfile.NamedTemporaryFile('w', suffix='.files', 
+                                         delete=False) as list_fh:
+            list_fh.writelines("%s\n" % target_file for target_file in files)
+
+        ## The list is removed whether or not tar succeeds so a failed task 
+        ## doesn't leave it behind.
+        try:
+            subprocess.check_call("tar --transform 's|.*/||' %s %s -T %s" % 
+                                  (tar_args, quote(task.targets[0].name), 
+                                   quote(list_fh.name)), shell=True)
+        finally:
+            os.remove(list_fh.name)
+
+    workflow.add_task(_tar_files,
                       depends = depend_files,
-                      targets = [output_tarball],
-                      args = [tmp_dir])
+                      targets = [output_tarball])
 
     return output_tarball
 
 
-def generate_md5_checksums(workflow, files):
+def generate_md5_checksums(workflow, files, parallel_md5=False, threads=8,
+                           integrity_hash=INTEGRITY_HASH, sentinel_dir=None):
     """Generates MD5 checksums for the provided set of files. All checksums 
     are written to a file containing the same name as the input but with the 
     "md5" extension appended.
 
+    A faster non-cryptographic checksum (e.g. xxHash or BLAKE3) can be used
+    instead by passing one of the CHECKSUM_TOOLS as the integrity_hash; the
+    checksum files then carry that tool's extension.
+
     Args:
         workflow (anadama2.Workflow): The workflow object.
-        files (list): A list of files to package together into a tarball.
+        files (list or PathSet): A list of files to package together into a 
+            tarball.
         output_tarball (string): The desired output tarball file.
+        parallel_md5 (boolean): If set to True hash PARALLEL_MD5_BLOCK_SIZE 
+            chunks of each file concurrently and record the md5 checksum of
+            the chunk checksums. These checksums are specific to the chunk 
+            size and are NOT comparable to plain md5sum output; verify them 
+            with verify_files(parallel_md5=True).
+        threads (int): Number of chunks hashed concurrently when parallel_md5
+            is set.
+        integrity_hash (tuple): The checksum tool and checksum file 
+            extension to use.
+        sentinel_dir (string): The sentinel directory passed to 
+            verify_files; each checksum then waits on the verification of 
+            the file being checksummed.
 
     Requires:
-        None
+        GNU parallel (optional)
+        xxHash or BLAKE3 (b3sum) if selected as the integrity_hash
 
     Returns:
         list: A list of the generated md5 checksum files.
@@ -277,13 +983,36 @@ def generate_md5_checksums(workflow, files):
 
         md5sum_files = common.generate_md5_checksums(workflow, files)
     """
+    files = _as_paths(files)
+
+    (checksum_tool, checksum_ext) = integrity_hash
+    if checksum_tool == 'md5sum':
+        checksum_tool = 'hmp_cached_md5.py'
+
     output_dir = os.path.dirname(files[0])
     checksum_files = bb_utils.name_files(bb_utils.sample_names(files),
                                          output_dir,
-                                         extension=".md5")
-
-    workflow.add_task_gridable('md5sum [depends[0]] > [targets[0]]',
-                               depends=files,
-                               targets=checksum_files)
+                                         extension=checksum_ext)
+
+    depend_files = files
+    if sentinel_dir:
+        depend_files = [[input_file, verified_sentinel(input_file, sentinel_dir)]
+                        for input_file in files]
+
+    ## Parallel checksums are written in the same "<checksum>  <file>" 
+    ## format as md5sum so verify_files can read them back.
+    if parallel_md5:
+        workflow.add_task_group_gridable('checksum=$(%s) && '
+                                         'printf \'%%s  %%s\\n\' "$checksum" [depends[0]] '
+                                         '> [targets[0]]' % _parallel_md5_cmd('[depends[0]]', 
+                                                                              '[args[0]]'),
+                                         depends=depend_files,
+                                         targets=checksum_files,
+                                         args=[threads],
+                                         cores=threads)
+    else:
+        workflow.add_task_group_gridable(checksum_tool + ' [depends[0]] > [targets[0]]',
+                                         depends=depend_files,
+                                         targets=checksum_files)
 
     return checksum_files
\ No newline at end of file
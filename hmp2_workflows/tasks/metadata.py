@@ -28,12 +28,32 @@ furnished to do so, subject to the following conditions:
     THE SOFTWARE.
 """
 
+import datetime
+import functools
+import glob
+import hashlib
 import os
+import re
 import tempfile
 
+from concurrent.futures import ThreadPoolExecutor
+
 import funcy
+import numpy as np
 import pandas as pd
 
+try:
+    import polars as pl
+except ImportError:
+    pl = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pa_compute
+    import pyarrow.csv as pa_csv
+except ImportError:
+    pa_csv = None
+
 from anadama2.tracked import Container
 
 import hmp2_workflows.utils.metadata as m_utils
@@ -43,6 +63,523 @@ from biobakery_workflows import utilities as bb_utils
 from hmp2_workflows.utils.misc import (get_sample_id_from_fname, 
                                        reset_column_headers)
 
+
+## Project ID suffixes for each data type
+_PROJECT_TYPE_MAP = {'host_transcriptomics': 'HTX',
+                     'biopsy_16S': 'BP',
+                     'metatranscriptomics': 'MTX',
+                     'metagenomics': 'MGX',
+                     'viromics': 'MVX',
+                     'host_genome': 'HG',
+                     'methylome': 'RRBS',
+                     'serology': 'SER'}
+
+## StudyTrax columns used to build other metadata columns which have to be
+## merged in even if they are dropped from the final metadata file
+_STUDYTRAX_MERGE_COLS = frozenset(['st_q4', 'st_q11', 'st_q17', 'bl_q4', 
+                                   'IntervalName', 'SiteName', 'Site', 
+                                   'week_num', 'interval_days', 'visit_num'])
+
+## Strings read as missing values alongside any file specific ones when 
+## parsing CSV files with polars; mirrors the pandas defaults
+_NA_VALUES = ['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN',
+              '-nan', '1.#IND', '1.#QNAN', 'N/A', 'NA', 'NULL', 'NaN', 'nan',
+              'null', 'None', 'n/a', '<NA>']
+
+## Buffer size used when streaming analysis PCL files out through Arrow
+_WRITE_BUFFER_SIZE = 8 * 1024 * 1024
+
+## Merged metadata columns filtered on by every add_metadata_to_tsv task; 
+## these are stored as categoricals so filters compare integer codes
+_METADATA_CATEGORY_COLS = ['data_type', 'External ID', 'Site/Sub/Coll ID']
+
+## Default directory holding the Feather snapshots written by read_cached_csv
+_CSV_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'hmp2_workflows_csv_cache')
+
+
+def _generate_external_ids(metadata_df):
+    """Generates the external ID for each row of metadata from the 
+    participant sample ID (st_q4) prefixed with the first letter of the 
+    collection site.
+
+    Args:
+        metadata_df (pandas.DataFrame): Rows of metadata.
+
+    Requires:
+        None
+
+    Returns:
+        pandas.Series: The external ID for each row of metadata.
+    """
+    base_ids = metadata_df['st_q4'].astype(object)
+    if 'bl_q4' in metadata_df.columns:
+        base_ids = base_ids.combine_first(metadata_df['bl_q4'].astype(object))
+
+    if base_ids.isnull().any():
+        raise ValueError('Could not generate External ID:', 
+                         metadata_df[base_ids.isnull()])
+
+    return (metadata_df['Site/Sub/Coll ID'].str[0] + 
+            base_ids.astype(str).str.replace('-', '', regex=False))
+
+
+def _get_project_ids(metadata_df):
+    """Generates the project ID for each row of metadata from the 
+    Site/Sub/Coll ID and data type, falling back to the proteomics job name
+    when one is present.
+
+    Args:
+        metadata_df (pandas.DataFrame): Rows of metadata.
+
+    Requires:
+        None
+
+    Returns:
+        pandas.Series: The project ID for each row of metadata.
+    """
+    project_ids = (metadata_df['Site/Sub/Coll ID'] + '_' + 
+                   metadata_df['data_type'].map(_PROJECT_TYPE_MAP))
+
+    if 'Job' in metadata_df.columns:
+        project_ids = project_ids.where(metadata_df['Job'].isnull(), 
+                                        metadata_df['Job'])
+
+    return project_ids
+
+
+def _missing_to_nan(csv_df):
+    """Replaces the None values Arrow uses for missing strings with NaN (in 
+    place) to match what the pandas C parser produces.
+
+    Args:
+        csv_df (pandas.DataFrame): DataFrame read through Arrow.
+
+    Requires:
+        None
+
+    Returns:
+        pandas.DataFrame: The same DataFrame.
+    """
+    for col in csv_df.columns[csv_df.dtypes == object]:
+        values = csv_df[col]
+        csv_df[col] = values.where(values.notnull(), np.nan)
+
+    return csv_df
+
+
+def read_csv(csv_file, **kwargs):
+    """Reads a CSV file into a DataFrame using the multi-threaded PyArrow
+    CSV parser when this version of pandas and pyarrow support it, falling 
+    back to the default C parser otherwise. Either way the DataFrame 
+    returned matches what the C parser would produce; columns are only 
+    parsed as dates when requested via parse_dates and missing values are 
+    NaN.
+
+    Args:
+        csv_file (string): Path to the CSV file to read.
+        **kwargs: Any additional arguments to pass to pandas.read_csv.
+
+    Requires:
+        None
+
+    Returns:
+        pandas.DataFrame: The contents of the CSV file.
+    """
+    ## The PyArrow parser converts missing values to the strings 'nan' and 
+    ## 'None' when reading columns as strings so leave those to the C parser
+    if 'dtype' in kwargs:
+        return pd.read_csv(csv_file, **kwargs)
+
+    arrow_kwargs = dict(kwargs)
+    parse_dates = arrow_kwargs.pop('parse_dates', [])
+
+    ## PyArrow infers timestamps from any ISO-8601 looking column unless 
+    ## given a format to parse them with; one that can never match keeps 
+    ## them as strings.
+    arrow_kwargs.setdefault('date_format', '%%')
+
+    try:
+        csv_df = pd.read_csv(csv_file, engine='pyarrow', **arrow_kwargs)
+    except (ImportError, ValueError, TypeError):
+        return pd.read_csv(csv_file, **kwargs)
+
+    ## Plain dates (YYYY-MM-DD) are still inferred and come back as 
+    ## datetime.date objects so these are turned back into the original 
+    ## strings. Missing values come back as None rather than NaN.
+    for col in csv_df.columns[csv_df.dtypes == object]:
+        values = csv_df[col]
+        first_valid = values.first_valid_index()
+        if first_valid is not None and isinstance(values[first_valid], datetime.date):
+            csv_df[col] = values.map(lambda val: val.isoformat() if val is not None else val)
+    _missing_to_nan(csv_df)
+
+    ## The PyArrow parser also leaves date columns with missing values 
+    ## unparsed so we parse any dates ourselves.
+    for date_col in parse_dates:
+        csv_df[date_col] = pd.to_datetime(csv_df[date_col])
+
+    return csv_df
+
+
+def read_cached_csv(csv_file, cache_dir=None, **kwargs):
+    """Reads a CSV file into a DataFrame, keeping a Feather snapshot of the 
+    parsed DataFrame in a cache directory so that subsequent reads can skip 
+    re-parsing a file that has not changed. Snapshots are keyed on the path,
+    size and modification time (in nanoseconds) of the CSV file as well as 
+    the arguments it was read with; older snapshots of the same file are 
+    removed once a new one is written.
+
+    Args:
+        csv_file (string): Path to the CSV file to read.
+        cache_dir (string): Directory to keep snapshots in. Defaults to a 
+            directory under the system temporary directory.
+        **kwargs: Any additional arguments to pass to read_csv.
+
+    Requires:
+        None
+
+    Returns:
+        pandas.DataFrame: The contents of the CSV file.
+    """
+    cache_dir = cache_dir or _CSV_CACHE_DIR
+    csv_stat = os.stat(csv_file)
+
+    read_key = repr((os.path.abspath(csv_file), sorted(kwargs.items())))
+    cache_prefix = os.path.join(cache_dir, "%s.%s" % (
+        os.path.basename(csv_file),
+        hashlib.md5(read_key.encode('utf-8')).hexdigest()[:12]))
+    cache_file = "%s.%d.%d.feather" % (cache_prefix, csv_stat.st_mtime_ns,
+                                       csv_stat.st_size)
+
+    ## A snapshot that is truncated, was written by an incompatible pyarrow
+    ## or can't be read at all is ignored in favor of the CSV. Missing 
+    ## strings come back from Feather as None so these are made NaN again to
+    ## match a fresh read of the CSV.
+    if os.path.exists(cache_file):
+        try:
+            return _missing_to_nan(pd.read_feather(cache_file))
+        except (ImportError, ValueError, TypeError, IOError, OSError):
+            pass
+
+    csv_df = read_csv(csv_file, **kwargs)
+
+    ## Caching is best-effort; if feather support is not installed, the 
+    ## DataFrame can't be serialized or the directory isn't writeable we
+    ## just carry on with the parsed CSV. Other processes may be reading 
+    ## the snapshot so it is written under a temporary name and moved into
+    ## place.
+    tmp_cache_file = "%s.%d.tmp" % (cache_file, os.getpid())
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        csv_df.to_feather(tmp_cache_file)
+        os.rename(tmp_cache_file, cache_file)
+    except (ImportError, ValueError, TypeError, IOError, OSError):
+        if os.path.exists(tmp_cache_file):
+            os.remove(tmp_cache_file)
+        return csv_df
+
+    for old_cache_file in glob.glob(glob.escape(cache_prefix) + '.*.feather'):
+        if old_cache_file != cache_file:
+            try:
+                os.remove(old_cache_file)
+            except OSError:
+                pass
+
+    return csv_df
+
+
+@functools.lru_cache(maxsize=None)
+def _compile_col_replace(col_replace):
+    """Compiles a single alternation pattern matching any of the provided 
+    string fragments so that they can all be stripped in one pass. Patterns
+    are cached so repeated calls with the same fragments share one regex.
+
+    Args:
+        col_replace (tuple): String fragments to match.
+
+    Requires:
+        None
+
+    Returns:
+        re.Pattern: The compiled pattern.
+    """
+    return re.compile('|'.join(map(re.escape, col_replace)))
+
+
+def _make_temp_file(**kwargs):
+    """Creates a temporary file, closing the file descriptor opened by 
+    tempfile.mkstemp so that only the path is held on to.
+
+    Args:
+        **kwargs: Any arguments to pass to tempfile.mkstemp.
+
+    Requires:
+        None
+
+    Returns:
+        string: Path to the created temporary file.
+    """
+    (temp_fd, temp_file) = tempfile.mkstemp(**kwargs)
+    os.close(temp_fd)
+
+    return temp_file
+
+
+def _use_polars():
+    """Returns whether the opt-in polars metadata path should be used. This 
+    is enabled by setting HMP2_FAST_IO=1 in the environment and requires 
+    polars to be installed.
+
+    Args:
+        None
+
+    Requires:
+        None
+
+    Returns:
+        boolean: True if polars should be used to merge metadata.
+    """
+    return pl is not None and os.environ.get('HMP2_FAST_IO') == '1'
+
+
+def _studytrax_merge_cols(studytrax_cols, broad_cols, drop_cols):
+    """Returns the StudyTrax columns that need to be carried through the 
+    merge with the Broad sample sheet. Columns that will be dropped from 
+    the final metadata file are left out up front unless they are needed 
+    to build other metadata or share a name with a Broad column (which 
+    would change the suffixes added by the merge).
+
+    Args:
+        studytrax_cols (list): Columns present in the StudyTrax metadata.
+        broad_cols (list): Columns present in the Broad sample sheet.
+        drop_cols (set): Columns dropped from the final metadata file.
+
+    Requires:
+        None
+
+    Returns:
+        list: The StudyTrax columns to merge, in their original order.
+    """
+    return [col for col in studytrax_cols 
+            if col not in drop_cols or col in _STUDYTRAX_MERGE_COLS or
+               col in broad_cols]
+
+
+def _merge_studytrax_polars(broad_sample_sheet, studytrax_metadata, 
+                            sample_ids, drop_cols=frozenset()):
+    """Reads the Broad sample sheet and StudyTrax metadata with polars, 
+    subsets the Broad samples to the provided sample ID's and joins them to 
+    their StudyTrax records. Mirrors the pandas path in 
+    generate_metadata_file and hands back pandas DataFrames.
+
+    Args:
+        broad_sample_sheet (string): Path to the Broad sample tracking sheet.
+        studytrax_metadata (string): Path to the StudyTrax metadata.
+        sample_ids (list): Sample ID's to subset the Broad sample sheet to.
+        drop_cols (set): Columns dropped from the final metadata file which
+            need not be carried through the StudyTrax join.
+
+    Requires:
+        polars
+
+    Returns:
+        tuple: The full Broad sample sheet, the subset of the Broad sample 
+            sheet matching our samples and the subset merged with StudyTrax
+            metadata, all as pandas DataFrames.
+    """
+    date_col = 'Actual Date of Receipt'
+    sample_ids = list(set(sample_ids))
+
+    broad_sample_pl = pl.read_csv(broad_sample_sheet,
+                                  null_values=_NA_VALUES + ['destroyed', 'missed'],
+                                  infer_schema_length=None)
+    sample_mask = pl.any_horizontal([pl.col(col).cast(pl.Utf8).is_in(sample_ids)
+                                     for col in ['Parent Sample A', 'Proteomics',
+                                                 'MbX', 'Site/Sub/Coll']])
+    sample_subset_pl = broad_sample_pl.filter(sample_mask)
+
+    studytrax_pl = pl.scan_csv(studytrax_metadata, null_values=_NA_VALUES,
+                               infer_schema_length=None)
+    studytrax_cols = _studytrax_merge_cols(studytrax_pl.collect_schema().names(),
+                                           broad_sample_pl.columns,
+                                           drop_cols)
+    studytrax_pl = studytrax_pl.select(studytrax_cols)
+
+    ## Keep the same column suffixes the pandas merge would add to any 
+    ## columns found in both files.
+    shared_cols = set(sample_subset_pl.columns).intersection(studytrax_cols)
+    metadata_pl = (sample_subset_pl.lazy()
+                   .rename(dict((col, col + '_x') for col in shared_cols))
+                   .with_columns(pl.col('Parent Sample A').cast(pl.Utf8)
+                                 .alias('_join_id'))
+                   .join(studytrax_pl
+                         .filter(pl.col('st_q4').is_not_null())
+                         .unique(subset=['st_q4'], keep='first', 
+                                 maintain_order=True)
+                         .rename(dict((col, col + '_y') for col in shared_cols))
+                         .with_columns(pl.col('st_q4').cast(pl.Utf8)
+                                       .alias('_join_id')),
+                         on='_join_id', how='left', validate='m:1')
+                   .drop('_join_id')
+                   .collect())
+
+    broad_sample_df = broad_sample_pl.to_pandas()
+    sample_subset_df = sample_subset_pl.to_pandas()
+    metadata_df = metadata_pl.to_pandas()
+
+    for frame_df in (broad_sample_df, sample_subset_df):
+        frame_df[date_col] = pd.to_datetime(frame_df[date_col])
+    date_col = date_col + '_x' if date_col in shared_cols else date_col
+    metadata_df[date_col] = pd.to_datetime(metadata_df[date_col])
+
+    return (broad_sample_df, sample_subset_df, metadata_df)
+
+
+def _read_analysis_file(analysis_file, head_rows):
+    """Reads a tab-delimited analysis file as strings, splitting off the 
+    first head_rows rows (the header and any PCL metadata rows) as a small
+    pandas DataFrame. The remaining rows are kept as a PyArrow Table when 
+    PyArrow is available so that the bulk of the file is never converted 
+    to pandas.
+
+    Args:
+        analysis_file (string): Path to the analysis file.
+        head_rows (int): The number of rows to read into the header 
+            DataFrame.
+
+    Requires:
+        None
+
+    Returns:
+        tuple: A pandas DataFrame of the header rows with integer column 
+            labels and the remaining rows as a PyArrow Table (or pandas 
+            DataFrame without PyArrow).
+    """
+    if pa_csv is None:
+        head_df = pd.read_csv(analysis_file, sep='\t', dtype='str', 
+                              header=None, nrows=head_rows)
+        try:
+            body = pd.read_csv(analysis_file, sep='\t', dtype='str',
+                               header=None, skiprows=head_rows)
+        except pd.errors.EmptyDataError:
+            body = head_df[:0]
+
+        return (head_df, body)
+
+    ## Every column needs to be read as a string so we need to know how 
+    ## many columns to expect up front.
+    with open(analysis_file) as analysis_fh:
+        num_cols = len(analysis_fh.readline().rstrip('\r\n').split('\t'))
+    col_names = ['f%d' % idx for idx in range(num_cols)]
+
+    analysis_tbl = pa_csv.read_csv(analysis_file,
+                                   read_options=pa_csv.ReadOptions(column_names=col_names),
+                                   parse_options=pa_csv.ParseOptions(delimiter='\t'),
+                                   convert_options=pa_csv.ConvertOptions(
+                                       column_types=dict((col, pa.string()) 
+                                                         for col in col_names),
+                                       null_values=_NA_VALUES,
+                                       strings_can_be_null=True))
+
+    head_df = analysis_tbl.slice(0, head_rows).to_pandas()
+    head_df.columns = range(num_cols)
+
+    return (head_df, analysis_tbl.slice(head_rows))
+
+
+def _write_analysis_file(out_file, header_text, body, na_rep):
+    """Writes an analysis PCL file made up of an already formatted header 
+    block followed by the analysis rows returned by _read_analysis_file.
+    Arrow tables are streamed through a single buffered Arrow output stream.
+
+    Args:
+        out_file (string): Path to the file to write.
+        header_text (string): Tab-delimited header and metadata rows.
+        body (pyarrow.Table or pandas.DataFrame): The analysis rows to write.
+        na_rep (string): String representation for any empty cell.
+
+    Requires:
+        None
+
+    Returns:
+        None
+    """
+    if not isinstance(body, pd.DataFrame):
+        body = pa.table([pa_compute.fill_null(col, na_rep) for col in body.columns],
+                        names=body.column_names)
+
+        ## Arrow can only write unquoted values so anything that pandas would 
+        ## have quoted is handed back to pandas to write.
+        needs_quoting = any(pa_compute.any(pa_compute.match_substring_regex(col, '["\r\n]')).as_py()
+                            for col in body.columns)
+        if needs_quoting:
+            body = body.to_pandas()
+
+    if isinstance(body, pd.DataFrame):
+        with open(out_file, 'w') as out_fh:
+            out_fh.write(header_text)
+            body.to_csv(out_fh, sep='\t', header=False, index=False, 
+                        na_rep=na_rep)
+        return
+
+    with pa.output_stream(out_file, buffer_size=_WRITE_BUFFER_SIZE) as out_stream:
+        out_stream.write(header_text.encode('utf-8'))
+        pa_csv.write_csv(body, out_stream,
+                         write_options=pa_csv.WriteOptions(include_header=False,
+                                                           delimiter='\t',
+                                                           quoting_style='none'))
+
+
+@functools.lru_cache(maxsize=4)
+def _read_metadata(metadata_file, mtime_ns, size):
+    """Reads the provided merged metadata file. Results are cached on the 
+    path, modification time and size of the file so that the tasks added by
+    add_metadata_to_tsv share a single read of an unchanged file.
+
+    Args:
+        metadata_file (string): Absolute path to the merged metadata file.
+        mtime_ns (int): Modification time of the file in nanoseconds.
+        size (int): Size of the file in bytes.
+
+    Requires:
+        None
+
+    Returns:
+        pandas.DataFrame: The merged metadata with all columns as strings 
+            and the sample ID and data type columns as categoricals.
+    """
+    metadata_df = read_cached_csv(metadata_file, dtype='str',
+                                  parse_dates=['date_of_receipt'])
+
+    for col in _METADATA_CATEGORY_COLS:
+        if col in metadata_df:
+            metadata_df[col] = metadata_df[col].astype('category')
+
+    return metadata_df
+
+
+def _load_metadata(metadata_file):
+    """Reads the provided merged metadata file, re-using the DataFrame from 
+    any recent read of the file if it hasn't changed since.
+
+    The returned DataFrame is shared between callers and should not be 
+    modified.
+
+    Args:
+        metadata_file (string): Path to the merged metadata file.
+
+    Requires:
+        None
+
+    Returns:
+        pandas.DataFrame: The merged metadata with all columns as strings 
+            and the sample ID and data type columns as categoricals.
+    """
+    metadata_stat = os.stat(metadata_file)
+    return _read_metadata(os.path.abspath(metadata_file), 
+                          metadata_stat.st_mtime_ns, metadata_stat.st_size)
+
+
 def validate_metadata_file(workflow, input_file, validation_file):
     """Validates an HMP2 metadata file using the cutplace utility. 
     A valid cutplace interface definition file must exist for the provided 
@@ -117,58 +654,91 @@ def generate_metadata_file(workflow, config, data_files, studytrax_metadata,
 
         data_type_map = config.get('dtype_mapping')
 
-        studytrax_df = pd.read_csv(studytrax_metadata)
-        broad_sample_df = pd.read_csv(broad_sample_sheet, 
-                                      na_values=['destroyed', 'missed'],
-                                      parse_dates=['Actual Date of Receipt'])
-
-        collection_dates_dict = m_utils.get_collection_dates(broad_sample_df)
-
         if pair_identifier:
             (input_pair1, input_pair2) = bb_utils.paired_files(input_files, pair_identifier)
             input_files = input_pair1 if input_pair1 else input_files
 
-        sample_mapping = dict(zip(bb_utils.sample_names(input_files, pair_identifier),
-                               map(get_sample_id_from_fname, input_files)))        
-        sample_ids = [sid.replace(pair_identifier, '') for sid in sample_mapping.values()]
+        sample_mapping = dict((sample_name, get_sample_id_from_fname(input_file))
+                              for (sample_name, input_file) 
+                              in zip(bb_utils.sample_names(input_files, pair_identifier),
+                                     input_files))
+        sample_ids = list(sample_mapping.values())
+        if pair_identifier:
+            sample_ids = [sid.replace(pair_identifier, '') for sid in sample_ids]
 
-        sample_subset_df = broad_sample_df[(broad_sample_df['Parent Sample A'].isin(sample_ids)) |
-                                           (broad_sample_df['Proteomics'].isin(sample_ids)) |
-                                           (broad_sample_df['MbX'].isin(sample_ids)) |
-                                           (broad_sample_df['Site/Sub/Coll']).isin(sample_ids)]        
+        drop_cols = set(config.get('drop_cols') or [])
 
-        metadata_df = sample_subset_df.merge(studytrax_df,
-                                            left_on='Parent Sample A',
-                                            right_on='st_q4',
-                                            how='left')
+        if _use_polars():
+            (broad_sample_df, sample_subset_df, metadata_df) = \
+                _merge_studytrax_polars(broad_sample_sheet, 
+                                        studytrax_metadata,
+                                        sample_ids,
+                                        drop_cols)
+        else:
+            studytrax_df = read_csv(studytrax_metadata)
+            broad_sample_df = read_csv(broad_sample_sheet, 
+                                        na_values=['destroyed', 'missed'],
+                                        parse_dates=['Actual Date of Receipt'])
+
+            ## A sample can be matched on any of its Broad ID columns so we 
+            ## hash our sample ID's once and build a single mask across all 
+            ## of them
+            sample_id_cols = broad_sample_df[['Parent Sample A', 'Proteomics', 
+                                              'MbX', 'Site/Sub/Coll']]
+            sample_mask = sample_id_cols.isin(frozenset(sample_ids)).any(axis=1)
+            sample_subset_df = broad_sample_df[sample_mask.values]
+
+            ## Each Broad sample should map to at most one StudyTrax record so 
+            ## we index StudyTrax on its sample ID and have the merge enforce 
+            ## this. StudyTrax exports do repeat a sample ID now and then in 
+            ## which case the first visit is kept. Only columns that survive 
+            ## into our metadata file are carried through the merge.
+            studytrax_df = studytrax_df[_studytrax_merge_cols(studytrax_df.columns,
+                                                              broad_sample_df.columns,
+                                                              drop_cols)]
+            studytrax_df = (studytrax_df.dropna(subset=['st_q4'])
+                                        .drop_duplicates('st_q4', keep='first'))
+            studytrax_df = studytrax_df.set_index('st_q4', drop=False)
+            metadata_df = sample_subset_df.merge(studytrax_df,
+                                                left_on='Parent Sample A',
+                                                right_index=True,
+                                                how='left',
+                                                sort=False,
+                                                validate='m:1')
+
+        collection_dates_dict = m_utils.get_collection_dates(broad_sample_df)
 
         ## We sometimes get a situation where our studytrax metadata is missing
         ## some of the proteomics sample ID's so we need to make sure we replicate
         ## them
-        metadata_df.loc[metadata_df['st_q17'].isnull(), 'st_q17'] = metadata_df['Proteomics']
-        metadata_df.loc[metadata_df['st_q11'].isnull(), 'st_q11'] = metadata_df['MbX']
+        metadata_df['st_q17'] = metadata_df['st_q17'].fillna(metadata_df['Proteomics'])
+        metadata_df['st_q11'] = metadata_df['st_q11'].fillna(metadata_df['MbX'])
         metadata_df['data_type'] = data_type_map.get(data_type)
 
         if proteomics_metadata:
             proteomics_df = m_utils.add_proteomics_metadata(sample_subset_df, 
                                                             proteomics_metadata,
                                                             sample_mapping)
+            proteomics_df = proteomics_df.set_index('Parent Sample A')
             metadata_df = metadata_df.merge(proteomics_df,
-                                            on='Parent Sample A',
-                                            how='left')
-
+                                            left_on='Parent Sample A',
+                                            right_index=True,
+                                            how='left',
+                                            sort=False,
+                                            validate='m:1')
 
-        metadata_df['External ID'] = new_metadata_df.apply(generate_external_id, axis=1)
 
-        metadata_df['Site/Sub/Coll ID'] = metadata_df['Site/Sub/Coll'].map(lambda sid: str(sid))
+        metadata_df['Site/Sub/Coll ID'] = metadata_df['Site/Sub/Coll'].astype(str)
+        metadata_df['External ID'] = _generate_external_ids(metadata_df)
         metadata_df['Site'] = metadata_df['SiteName']
-        metadata_df['Participant ID'] = metadata_df['Subject'].map(lambda subj: 'C' + str(subj))
+        metadata_df['Participant ID'] = 'C' + metadata_df['Subject'].astype(str)
         metadata_df['visit_num'] = metadata_df['Collection #']
         metadata_df['Research Project'] = config.get('research_project')
-        metadata_df['Project'] = metadata_df.apply(m_utils.get_project_id, axis=1)
+        metadata_df['Project'] = _get_project_ids(metadata_df)
         metadata_df = generate_collection_statistics(metadata_df,
                                                      collection_dates_dict)
-        metadata_df = metadata_df.drop(config.get('drop_cols'), axis=1, inplace=True)
+        metadata_df = metadata_df[[col for col in metadata_df.columns 
+                                   if col not in drop_cols]]
  
         if auxillary_metadata:
             ## Auxillary metadata are columns that will be added into our
@@ -178,10 +748,10 @@ def generate_metadata_file(workflow, config, data_files, studytrax_metadata,
         metadata_df.to_csv(metadata_out_file, index=False)
 
 
-    for (data_type, items) in data_files.iteritems():
-        metadata_file = tempfile.mkstemp(prefix='%s_metadata_' % data_type,
-                                         suffix='.csv',
-                                         dir=temp_dir)[-1]
+    for (data_type, items) in data_files.items():
+        metadata_file = _make_temp_file(prefix='%s_metadata_' % data_type,
+                                        suffix='.csv',
+                                        dir=temp_dir)
         pair_identifier = items.get('pair_identifier', '')
         sequence_files = items.get('input')
 
@@ -208,7 +778,7 @@ def generate_metadata_file(workflow, config, data_files, studytrax_metadata,
 
 
 def generate_sample_metadata(workflow, data_type, in_files, metadata_file, 
-                             output_dir, id_column = 'External ID'):
+                             output_dir, id_column = 'External ID', threads=4):
     """Generates a series of individual metadata files in CSV format 
     from the provided merged metadata file. Each of the provided samples
     has a metadata file generated to accompany any product files generated 
@@ -226,6 +796,8 @@ def generate_sample_metadata(workflow, data_type, in_files, metadata_file,
             can change depending on the data type.
         output_dir (string): Path to output directory to write each 
             sample metadata file too.
+        threads (int): Number of threads used to write sample metadata 
+            files concurrently. Default set to 4.
 
     Requires:
         None
@@ -251,7 +823,7 @@ def generate_sample_metadata(workflow, data_type, in_files, metadata_file,
         print metadata_files
         ## ['/tmp/metadata/sampleA.csv', '/tmp/metadata/sampleB.csv']
     """
-    metadata_df = pd.read_csv(metadata_file)
+    metadata_df = read_csv(metadata_file)
     samples = bb_utils.sample_names(in_files)
 
     output_metadata_files = bb_utils.name_files(samples, 
@@ -269,9 +841,15 @@ def generate_sample_metadata(workflow, data_type, in_files, metadata_file,
             raise ValueError('Could not find metadata associated with samples.',
                              ",".join(samples))
 
-        for (sample_id, row) in metadata_subset.iterrows():
-            sample_metadata_file = sample_metadata_dict.get(row[id_column])
-            metadata_subset.xs(sample_id).to_csv(sample_metadata_file, index=False)
+        def _write_sample_metadata(sample_group):
+            (sample_id, sample_df) = sample_group
+            sample_df.to_csv(sample_metadata_dict.get(sample_id), index=False)
+
+        ## Each sample's metadata goes to its own file so the writes are 
+        ## independent of one another and can be spread over a thread pool.
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            list(executor.map(_write_sample_metadata,
+                              metadata_subset.groupby(id_column, sort=False)))
     
     workflow.add_task(_workflow_gen_metadata,
                       targets=output_metadata_files,  
@@ -349,14 +927,23 @@ def add_metadata_to_tsv(workflow, analysis_files, metadata_file, dtype,
         print out_files
         ## ['/tmp/metaphlan2.out']
     """
-    metadata_df = pd.read_csv(metadata_file, dtype='str',
-                              parse_dates=['date_of_receipt'])
+    col_replace_re = _compile_col_replace(tuple(col_replace)) if col_replace else None
+
+    # Because of how YAML inherits lists we'll need to see if we can't 
+    # flatten this list out. This is done once here rather than in each 
+    # task along with prepending our ID column.
+    if target_cols:
+        target_cols = [id_col] + list(funcy.flatten(target_cols))
     
     def _workflow_add_metadata_to_tsv(task):
         analysis_file = task.depends[0].name
         pcl_out = task.targets[0].name
+        metadata_df = _load_metadata(metadata_file)
 
-        analysis_df = pd.read_csv(analysis_file, dtype='str', header=None)
+        ## Only the header and PCL metadata rows are needed in pandas; the 
+        ## rest of the analysis file is written back out untouched.
+        (analysis_df, analysis_rows) = _read_analysis_file(analysis_file, 
+                                                           (metadata_rows or 0) + 1)
         pcl_metadata_df = None
         header = True
             
@@ -369,20 +956,19 @@ def add_metadata_to_tsv(workflow, analysis_files, metadata_file, dtype,
             header = None
 
             offset_cols = range(0, col_offset+1)
-            pcl_metadata_df.drop(pcl_metadata_df.columns[offset_cols[:-1]], 
-                                    axis=1,
-                                    inplace=True)
+            pcl_metadata_df = pcl_metadata_df.drop(pcl_metadata_df.columns[offset_cols[:-1]], 
+                                                   axis=1)
 
             pcl_metadata_df = pcl_metadata_df.T.reset_index(drop=True).T
-            pcl_metadata_df.xs(metadata_rows)[0] = id_col
+            pcl_metadata_df.loc[metadata_rows, 0] = id_col
             
             pcl_metadata_df = pcl_metadata_df.T
             pcl_metadata_df = reset_column_headers(pcl_metadata_df)
 
-            analysis_df.drop(analysis_df.index[range(0,metadata_rows)], inplace=True)
-            analysis_df.rename(columns=analysis_df.iloc[0], inplace=True)
+            analysis_df = analysis_df.drop(analysis_df.index[range(0,metadata_rows)])
+            analysis_df = analysis_df.rename(columns=analysis_df.iloc[0])
         else:
-            analysis_df = hmp2_utils.misc.reset_column_headers(analysis_df)
+            analysis_df = reset_column_headers(analysis_df)
 
         sample_ids = analysis_df.columns.tolist()[col_offset+1:]
             
@@ -390,88 +976,96 @@ def add_metadata_to_tsv(workflow, analysis_files, metadata_file, dtype,
             raise ValueError('Could not parse sample ID\'s:', 
                              sample_ids)
 
-        if col_replace:
-            new_ids = sample_ids
-            for replace_str in col_replace:
-                new_ids = [sid.replace(replace_str, '') if not pd.isnull(sid) 
-                           else sid for sid in new_ids]
+        if col_replace_re:
+            new_ids = pd.Index(sample_ids).str.replace(col_replace_re, '', 
+                                                       regex=True).tolist()
 
             if new_ids != sample_ids:
                 sample_ids_map = dict(zip(sample_ids, new_ids))
                 sample_ids = new_ids
     
-                analysis_df.rename(columns=sample_ids_map, inplace=True)
+                analysis_df = analysis_df.rename(columns=sample_ids_map)
 
         subset_metadata_df = metadata_df[(metadata_df.data_type == dtype) &
                                          (metadata_df[id_col].isin(sample_ids))]
+        subset_metadata_df = subset_metadata_df.astype(dict((col, object) for col 
+                                                            in _METADATA_CATEGORY_COLS
+                                                            if col in subset_metadata_df))
 
         if aux_files:
+            metadata_cols = subset_metadata_df.columns.tolist()
+            subset_metadata_df = subset_metadata_df.reset_index(drop=True)
+
             for aux_file in aux_files:
-                aux_metadata_df = pd.read_table(aux_file, dtype='str')
-                aux_metadata_cols = aux_metadata_df.columns.tolist()
-                join_id = aux_metadata_cols[0]
-
-                ## We need to do this in two stages. If the columns already exist
-                ## here we want to update them. If they do not exist we append
-                ## them.
-                subset_metadata_cols = subset_metadata_df.columns.tolist()
-                new_cols = set(aux_metadata_cols[1:]) - set(subset_metadata_cols)
-                existing_cols = set(aux_metadata_cols[1:]).intersection(subset_metadata_cols)
-
-                if new_cols:
-                    aux_metadata_new_df = aux_metadata_df.filter(items=aux_metadata_cols[:1] + 
-                                                                 list(new_cols))
-                    subset_metadata_df = pd.merge(subset_metadata_df, aux_metadata_new_df, 
-                                                  how='left', on=join_id)
-
-                if existing_cols:
-                    aux_metadata_existing_df = aux_metadata_df.filter(items=aux_metadata_cols[:1] + 
-                                                                      list(existing_cols))
-                    subset_metadata_df.set_index(join_id, inplace=True)
-                    aux_metadata_existing_df.set_index(join_id, inplace=True)
-
-                    subset_metadata_df.update(aux_metadata_existing_df)
-                    subset_metadata_df.reset_index(inplace=True)
-
-        if not pcl_metadata_df.empty:
-            subset_metadata_df = pd.merge(subset_metadata_df, pcl_metadata_df,
-                                          how='left', on=id_col)
+                aux_metadata_df = read_csv(aux_file, sep='\t', dtype='str')
+                join_id = aux_metadata_df.columns[0]
+
+                ## Auxillary files generally share a join column so we only
+                ## re-index our metadata when the join column changes.
+                if subset_metadata_df.index.name != join_id:
+                    if subset_metadata_df.index.name is not None:
+                        subset_metadata_df = subset_metadata_df.reset_index()
+                    subset_metadata_df = subset_metadata_df.set_index(join_id)
+
+                ## Once aligned to our metadata a single combine_first both 
+                ## appends any new columns and updates existing ones with any
+                ## values present in the auxillary file.
+                aux_metadata_df = (aux_metadata_df.set_index(join_id)
+                                                  .reindex(subset_metadata_df.index))
+                metadata_cols.extend(col for col in aux_metadata_df.columns
+                                     if col not in metadata_cols)
+                subset_metadata_df = aux_metadata_df.combine_first(subset_metadata_df)
+
+            subset_metadata_df = subset_metadata_df.reset_index()[metadata_cols]
+
+        if pcl_metadata_df is not None and not pcl_metadata_df.empty:
+            subset_metadata_df = pd.merge(subset_metadata_df, 
+                                          pcl_metadata_df.set_index(id_col),
+                                          how='left', left_on=id_col,
+                                          right_index=True, sort=False,
+                                          validate='m:1')
 
         if target_cols:
-            target_cols.insert(0, id_col)
             subset_metadata_df = subset_metadata_df.filter(target_cols)
 
-        subset_metadata_df = subset_metadata_df.T
-        subset_metadata_df = reset_column_headers(subset_metadata_df)
-        subset_metadata_df = subset_metadata_df.reset_index()
-        subset_metadata_df.fillna('NA', inplace=True)
+        ## Transpose our metadata so each sample is a column headed by its ID 
+        ## building the new frame straight from the underlying array rather 
+        ## than copying it through a transpose, header reset and re-index.
+        metadata_cols = subset_metadata_df.columns[1:]
+        metadata_values = subset_metadata_df.values
+        sample_headers = metadata_values[:, 0]
+        metadata_values = metadata_values[:, 1:].T
+        metadata_values = np.where(pd.isnull(metadata_values), 'NA', 
+                                   metadata_values)
+
+        subset_metadata_df = pd.DataFrame(metadata_values, 
+                                          columns=sample_headers)
+        subset_metadata_df.insert(0, 'index', metadata_cols)
 
         _col_offset = col_offset-1 if col_offset != -1 else col_offset
         col_name = analysis_df.columns[_col_offset+1]
 
         col_name = '' if col_name == "index" else col_name
-        subset_metadata_df.rename(columns={'index': col_name}, inplace=True)
-
-        analysis_df.index = analysis_df.index + len(subset_metadata_df.index)
-
-        analysis_metadata_df = pd.concat([subset_metadata_df,
-                                          analysis_df], axis=0)
-        analysis_metadata_df = analysis_metadata_df[analysis_df.columns]
-        analysis_metadata_df.to_csv(pcl_out, 
-                                    index=False, 
-                                    header=header, 
-                                    sep='\t',
-                                    na_rep=na_rep)
+        subset_metadata_df = subset_metadata_df.rename(columns={'index': col_name})
+
+        ## Both blocks are object arrays once lined up on the analysis file's
+        ## columns so we can stack them directly rather than concatenating.
+        metadata_values = subset_metadata_df.reindex(columns=analysis_df.columns).values
+        analysis_metadata_df = pd.DataFrame(np.concatenate([metadata_values, 
+                                                            analysis_df.values.astype(object)]),
+                                            columns=analysis_df.columns)
+        header_text = analysis_metadata_df.to_csv(None,
+                                                  index=False, 
+                                                  header=header, 
+                                                  sep='\t',
+                                                  na_rep=na_rep)
+        _write_analysis_file(pcl_out, header_text, analysis_rows, na_rep)
 
     output_folder = os.path.dirname(analysis_files[0])
     pcl_files = bb_utils.name_files(analysis_files, 
                                     output_folder, 
                                     extension="pcl.tsv")
 
-    # Because of how YAML inherits lists we'll need to see if we can't 
-    # flatten this list out. 
-    target_cols = funcy.flatten(target_cols)
-
     workflow.add_task_group(_workflow_add_metadata_to_tsv,
                             depends=analysis_files,
                             targets=pcl_files,